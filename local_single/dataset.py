@@ -1,13 +1,495 @@
 import pickle
 import sys
+import os
+import zlib
+import lzma
+import warnings
+import resource
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, BatchSampler
 from torch.utils.data._utils.collate import default_convert
 
 import time
 
-from torch_geometric.data import Data
+from torch_geometric.data import Data, Batch
+
+def open_input_store(store_path):
+    '''
+    Memory-maps (read only) an input store written by preprocessing_era5.py --store;
+    the data is only read from disk when sliced, and the page cache is shared by
+    all the processes that map the same store
+    Returns:
+        the np.memmap of shape header['shape'] and the header dict
+    '''
+    with open(os.path.join(store_path, 'header.pkl'), 'rb') as f:
+        header = pickle.load(f)
+    input = np.memmap(os.path.join(store_path, 'data.bin'), dtype=header['dtype'], mode='r', shape=tuple(header['shape']))
+    return input, header
+
+def get_decompressor(codec):
+    if codec == 'zlib':
+        return zlib.decompress
+    elif codec == 'lzma':
+        return lzma.decompress
+    elif codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress
+    raise ValueError(f"Unknown codec '{codec}'.")
+
+def upcast(window, precision):
+    '''
+    Converts a window read from a reduced precision store to float32
+    (bfloat16 values are stored as the upper 16 bits of the float32 values)
+    '''
+    if precision == 'bfloat16':
+        return (window.astype(np.uint32) << 16).view(np.float32)
+    return window.astype(np.float32)
+
+def load_input_stats(stats_path, means_file, stds_file, n_params):
+    '''
+    Loads the statistics written by preprocessing_era5.py, as float32 arrays that broadcast
+    over a (time, var, lev, lat, lon) window, per variable or per (variable, level)
+    Returns:
+        means, stds: arrays of shape (1, n_params, 1, 1, 1) or (1, n_params, n_levels, 1, 1)
+    '''
+    with open(stats_path + means_file, 'rb') as f:
+        means = np.asarray(pickle.load(f), dtype=np.float32)
+    with open(stats_path + stds_file, 'rb') as f:
+        stds = np.asarray(pickle.load(f), dtype=np.float32)
+    if means.shape[0] != n_params or means.shape != stds.shape:
+        raise ValueError(f"The statistics of shape {means.shape}, {stds.shape} do not match the {n_params} variables of the input store.")
+    shape = (1, -1, 1, 1, 1) if means.ndim == 1 else (1,) + means.shape + (1, 1)
+    return means.reshape(shape), stds.reshape(shape)
+
+def select_variables_and_levels(params, n_levels, variables=None, level_idxs=None):
+    '''
+    Maps the selected variables (names) and levels (indexes along the level axis) to the
+    indexes of the input; None selects everything
+    Returns:
+        var_idxs, lev_idxs: int arrays
+    '''
+    if variables is None:
+        var_idxs = np.arange(len(params))
+    else:
+        missing = [v for v in variables if v not in params]
+        if len(missing) > 0:
+            raise ValueError(f"Variables {missing} are not in the input, which has {params}.")
+        var_idxs = np.array([params.index(v) for v in variables])
+    lev_idxs = np.arange(n_levels) if level_idxs is None else np.array(level_idxs)
+    if len(lev_idxs) > 0 and (lev_idxs.min() < 0 or lev_idxs.max() >= n_levels):
+        raise ValueError(f"Level indexes {level_idxs} out of range for {n_levels} levels.")
+    return var_idxs, lev_idxs
+
+def unpack_mask_column(mask, time_idx, nodes):
+    '''
+    Reads the flags of the given nodes at one time step from a bit-packed, time-major
+    mask (preprocessing/utils_targets.py), without unpacking the whole row
+    Arguments:
+        mask: dict with the 'packed' (time, ceil(n_nodes / 8)) uint8 array
+        time_idx: the time index
+        nodes: int array with the node indexes
+    Returns:
+        a boolean array with the flag of each node
+    '''
+    row = mask['packed'][time_idx]
+    return ((row[nodes >> 3] >> (7 - (nodes & 7))) & 1).astype(bool)
+
+def gather_sparse_column(target, time_idx, nodes):
+    '''
+    Reads the values of the given nodes at one time step from a sparse, time-major target
+    (preprocessing/utils_targets.py); the nodes without a stored value get nan
+    Arguments:
+        target: dict with the 'indptr', 'indices' and 'values' arrays
+        time_idx: the time index
+        nodes: sorted int array with the node indexes
+    Returns:
+        a float32 array with the value of each node
+    '''
+    start, end = target['indptr'][time_idx], target['indptr'][time_idx+1]
+    if end == start:
+        return np.full(len(nodes), np.nan, dtype=np.float32)
+    row_nodes = target['indices'][start:end]
+    pos = np.minimum(np.searchsorted(row_nodes, nodes), end - start - 1)
+    return np.where(row_nodes[pos] == nodes, target['values'][start:end][pos], np.float32(np.nan))
+
+def time_major_target(target):
+    '''
+    Returns a target as either a sparse time-major dict (preprocessing/utils_targets.py) or a
+    contiguous float32 (time, n_nodes) array; the older (n_nodes, time) tensors are transposed once
+    '''
+    if isinstance(target, dict):
+        return target['dense'] if 'dense' in target else target
+    return np.ascontiguousarray(np.asarray(target, dtype=np.float32).T)
+
+def time_major_mask(mask):
+    '''
+    Returns a mask in the bit-packed time-major format; the older (n_nodes, time) boolean
+    tensors are packed once
+    '''
+    if isinstance(mask, dict):
+        return mask
+    mask = np.asarray(mask, dtype=bool)
+    return {'packed': np.packbits(mask.T, axis=1), 'n_nodes': mask.shape[0], 'layout': 'time_major'}
+
+class Compressed_input(object):
+    '''
+    Read-only, array-like view of a compressed input store (preprocessing_era5.py --codec);
+    the time chunks are decompressed on demand and kept in a bounded LRU cache, whose
+    hits and misses are counted
+    '''
+    def __init__(self, store_path, header, cache_chunks=64):
+        self.path = os.path.join(store_path, 'chunks.bin')
+        self.header = header
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.chunk_hours = header['chunk_hours']
+        self.offsets = header['offsets']
+        self.decompress = get_decompressor(header['codec'])
+        self.cache_chunks = cache_chunks
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._fd = None
+        self._pid = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def cache_info(self):
+        n = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / n if n > 0 else 0.0,
+            'cached_chunks': len(self.cache), 'max_cached_chunks': self.cache_chunks}
+
+    def _read_chunk(self, c):
+        if c in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(c)
+            return self.cache[c]
+        self.misses += 1
+        if self._fd is None or self._pid != os.getpid():                    # do not share the file offset with forked workers
+            self._fd = os.open(self.path, os.O_RDONLY)
+            self._pid = os.getpid()
+        start, end = int(self.offsets[c]), int(self.offsets[c+1])
+        chunk = np.frombuffer(self.decompress(os.pread(self._fd, end - start, start)), dtype=self.dtype).reshape((-1,) + self.shape[1:])
+        self.cache[c] = chunk
+        if len(self.cache) > self.cache_chunks:
+            self.cache.popitem(last=False)
+        return chunk
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        t, other = key[0], (slice(None),) + key[1:]
+        if not isinstance(t, slice):
+            t = int(t)
+            return self.__getitem__((slice(t, t+1),) + key[1:])[0]
+        start, stop, step = t.indices(self.shape[0])
+        if step != 1:
+            raise IndexError("Only contiguous time slices are supported.")
+        pieces = []
+        for c in range(start // self.chunk_hours, (stop - 1) // self.chunk_hours + 1):
+            c_start = c * self.chunk_hours
+            chunk = self._read_chunk(c)
+            pieces.append(chunk[max(start - c_start, 0) : stop - c_start][other])
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces, axis=0)
+
+class Subgraph_store(object):
+    '''
+    The per-cell subgraphs written by make_subgraphs_single.py as flat, memory-mapped arrays;
+    the subgraph of a cell is built from slices of them, so nothing is cloned
+    '''
+    def __init__(self, store_path):
+        with open(os.path.join(store_path, 'header.pkl'), 'rb') as f:
+            self.header = pickle.load(f)
+        self.arrays = {name: np.load(os.path.join(store_path, name + '.npy'), mmap_mode='r') for name in self.header['arrays']}
+
+    def __len__(self):
+        return self.header['n_cells']
+
+    def nodes(self, cell):
+        '''
+        Returns the (sorted) graph node ids of a cell
+        '''
+        node_ptr = self.arrays['node_ptr']
+        return self.arrays['node_ids'][node_ptr[cell]:node_ptr[cell+1]]
+
+    def __getitem__(self, cell):
+        nodes = self.nodes(cell).astype(np.int64)
+        nodes_9_ptr, edge_ptr = self.arrays['nodes_9_ptr'], self.arrays['edge_ptr']
+        edges = slice(edge_ptr[cell], edge_ptr[cell+1])
+        subgraph = Data(num_nodes=len(nodes), x=torch.from_numpy(self.arrays['x'][nodes]),
+            edge_index=torch.from_numpy(self.arrays['edge_index'][:, edges].astype(np.int64)),
+            low_res=torch.from_numpy(self.arrays['low_res'][nodes]))
+        if 'edge_attr' in self.arrays:
+            subgraph["edge_attr"] = torch.from_numpy(np.array(self.arrays['edge_attr'][edges]))
+        subgraph["mask_1_cell"] = torch.from_numpy(nodes)                  # graph node ids of the cell
+        subgraph["mask_9_cells"] = torch.from_numpy(self.arrays['nodes_9_ids'][nodes_9_ptr[cell]:nodes_9_ptr[cell+1]].astype(np.int64))
+        return subgraph
+
+def load_subgraphs(path):
+    '''
+    Opens a subgraph store (directory), or loads the older pickled list of subgraphs
+    '''
+    if os.path.isdir(path):
+        return Subgraph_store(path)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+class Cell_tensors(object):
+    '''
+    The static tensors of the subgraph of each cell (x, edge_index, edge_attr and the number of
+    nodes), built once from a subgraph store or from the older list of subgraphs; a batch of
+    examples is then assembled by concatenating the pieces of its cells, with the edges shifted
+    by the node offsets, instead of cloning one Data object per example
+    '''
+    def __init__(self, subgraphs):
+        n_cells = len(subgraphs)
+        self.num_nodes = np.zeros(n_cells, dtype=np.int64)
+        self.num_edges = np.zeros(n_cells, dtype=np.int64)
+        self.x, self.edge_index, self.edge_attr = [None] * n_cells, [None] * n_cells, [None] * n_cells
+        for s in range(n_cells):
+            subgraph = subgraphs[s]
+            if not isinstance(subgraph, Data):                              # cell without nodes in the older lists
+                continue
+            self.num_nodes[s], self.num_edges[s] = subgraph.num_nodes, subgraph.edge_index.shape[1]
+            self.x[s], self.edge_index[s] = subgraph.x, subgraph.edge_index
+            if "edge_attr" in subgraph:
+                self.edge_attr[s] = subgraph.edge_attr
+
+    def batch(self, cells):
+        '''
+        Returns the Batch of the subgraphs of the given cells (one per example, repetitions allowed)
+        '''
+        num_nodes, num_edges = self.num_nodes[cells], self.num_edges[cells]
+        ptr = np.zeros(len(cells) + 1, dtype=np.int64)
+        np.cumsum(num_nodes, out=ptr[1:])
+        edge_index = torch.cat([self.edge_index[s] for s in cells], dim=1) + torch.from_numpy(np.repeat(ptr[:-1], num_edges))
+        data_batch = Batch(x=torch.cat([self.x[s] for s in cells]), edge_index=edge_index,
+            batch=torch.from_numpy(np.repeat(np.arange(len(cells)), num_nodes)), ptr=torch.from_numpy(ptr))
+        if self.edge_attr[cells[0]] is not None:
+            data_batch.edge_attr = torch.cat([self.edge_attr[s] for s in cells])
+        data_batch._num_graphs = len(cells)
+        return data_batch
+
+def window_offsets(strides, var_idxs, lev_idxs, side):
+    '''
+    Offsets, from the first element of a window, of the runs along lon of a (25, var, lev, lat, lon)
+    window of an array with the given (time, var, lev, lat, lon) strides (in elements)
+    Returns:
+        int64 array of shape (25, len(var_idxs), len(lev_idxs), side)
+    '''
+    offsets = (np.arange(25)[:, None, None, None] * strides[0] + np.asarray(var_idxs)[None, :, None, None] * strides[1]
+        + np.asarray(lev_idxs)[None, None, :, None] * strides[2] + np.arange(side)[None, None, None, :] * strides[3])
+    return offsets.astype(np.int64)
+
+def window_runs(flat, side, lon_stride=1):
+    '''
+    View of a flat tensor as the (overlapping) runs of side elements along lon starting at each position
+    '''
+    return flat.as_strided((flat.numel() - (side - 1) * lon_stride, side), (1, lon_stride))
+
+class Time_grouped_sampler(BatchSampler):
+    '''
+    Batch sampler that groups the examples by time index: the examples of one time index are
+    consecutive (in random order), the order of the time indexes is shuffled and the batches are
+    cut from the resulting sequence, so that a batch reads only a few 25-hour blocks of the input
+    (a BatchSampler, so that accelerate splits its batches between the processes when it is the
+    sampler of a DataLoader with batch_size=None)
+    Arguments:
+        time_idxs: the time index of each example (Dataset_pr.example_time_idxs)
+        batch_size: number of examples per batch
+        shuffle: if False, the examples are in order of time
+        seed: seed of the shuffling, which depends on seed and epoch only, so that all the processes
+            of a distributed run (accelerate) produce the same batches and split them
+    '''
+    def __init__(self, time_idxs, batch_size, shuffle=True, drop_last=False, seed=0):
+        time_idxs = np.asarray(time_idxs)
+        self.order = np.argsort(time_idxs, kind='stable')
+        sorted_times = time_idxs[self.order]
+        self.group_of = np.cumsum(np.r_[False, sorted_times[1:] != sorted_times[:-1]])   # group of each sorted example
+        self.n_groups = int(self.group_of[-1]) + 1 if len(time_idxs) > 0 else 0
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        order = self.order
+        rng = np.random.default_rng((self.seed, self.epoch))
+        self.epoch += 1
+        if self.shuffle:
+            group_rank = rng.permutation(self.n_groups)
+            order = order[np.lexsort((rng.random(len(order)), group_rank[self.group_of]))]
+        for start in range(0, len(order), self.batch_size):
+            if self.drop_last and start + self.batch_size > len(order):
+                break
+            yield order[start : start + self.batch_size].tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.order) // self.batch_size
+        return (len(self.order) + self.batch_size - 1) // self.batch_size
+
+def storage_read_bytes():
+    '''
+    Bytes read from storage by the process so far (read_bytes of /proc/self/io, or the block
+    input operations of getrusage where it is not available)
+    '''
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('read_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_inblock * 512
+
+def sum_over_processes(value):
+    '''
+    Sums a number over the processes of a distributed run (torch.distributed, as set up by
+    accelerate); returns it unchanged in a single process. Every process must call it
+    '''
+    if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+        return value
+    device = torch.device('cuda', torch.cuda.current_device()) if torch.distributed.get_backend() == 'nccl' else torch.device('cpu')
+    total = torch.tensor([value], dtype=torch.float64, device=device)
+    torch.distributed.all_reduce(total)
+    return total.item()
+
+class Block_shuffle_sampler(BatchSampler):
+    '''
+    Batch sampler for an input that does not fit in memory: the time axis is cut in blocks of
+    block_hours, the order of the blocks is shuffled and the examples are shuffled within groups
+    of resident_blocks consecutive blocks (in the shuffled order), so that only the input of those
+    blocks (and of the 24 hours before each) is read at a time, while the next group is prefetched
+    in the background; the read amplification of each epoch (bytes read from storage over the
+    bytes of input covered by the examples) is appended to log_file. The order depends only on
+    seed and epoch, so that all the processes of a distributed run (accelerate) produce the same
+    batches, split them and read (and prefetch) the same blocks; the bytes read are summed over
+    the processes, which share the page cache when they run on one node
+    Arguments:
+        time_idxs: the time index of each example (Dataset_pr.example_time_idxs)
+        batch_size: number of examples per batch
+        block_hours, resident_blocks: size of the blocks and number of blocks shuffled together
+        prefetch_fn: function(time_start, time_stop) reading the input of those time steps
+            (Dataset_pr.prefetch), or None
+        bytes_per_hour: size of one hour of the input (Dataset_pr.input_bytes_per_hour), None if unknown
+        log_file: file where the statistics of each epoch are appended, None to skip them (e.g.
+            in the processes other than the main one)
+        seed: seed of the shuffling, the same in all the processes
+    '''
+    def __init__(self, time_idxs, batch_size, block_hours=168, resident_blocks=8, prefetch_fn=None, bytes_per_hour=None,
+        log_file=None, drop_last=False, seed=0):
+        time_idxs = np.asarray(time_idxs, dtype=np.int64)
+        block_of = time_idxs // block_hours
+        self.order = np.argsort(block_of, kind='stable')                    # examples grouped by block
+        self.blocks, counts = np.unique(block_of, return_counts=True)
+        self.block_ptr = np.zeros(len(self.blocks) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.block_ptr[1:])
+        self.batch_size = batch_size
+        self.block_hours = block_hours
+        self.resident_blocks = resident_blocks
+        self.prefetch_fn = prefetch_fn
+        self.bytes_per_hour = bytes_per_hour
+        self.log_file = log_file
+        self.drop_last = drop_last
+        self.seed = seed
+        #-- hours of input read by the examples, [time_idx - 24, time_idx]
+        covered = np.zeros(time_idxs.max(initial=0) + 2, dtype=np.int64)
+        np.add.at(covered, np.maximum(time_idxs - 24, 0), 1)
+        np.add.at(covered, time_idxs + 1, -1)
+        self.covered_hours = int((np.cumsum(covered) > 0).sum())
+        self.epoch = 0
+
+    def _prefetch(self, group):
+        for b in group:
+            self.prefetch_fn(int(self.blocks[b]) * self.block_hours, (int(self.blocks[b]) + 1) * self.block_hours)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        epoch = self.epoch
+        self.epoch += 1
+        rng = np.random.default_rng((self.seed, epoch))
+        block_order = rng.permutation(len(self.blocks))
+        groups = [block_order[g : g + self.resident_blocks] for g in range(0, len(block_order), self.resident_blocks)]
+        read_start, time_start = storage_read_bytes(), time.time()
+        executor = ThreadPoolExecutor(max_workers=1) if self.prefetch_fn is not None else None
+        futures = []
+        n_batches = 0
+        try:
+            if executor is not None and len(groups) > 0:
+                futures.append(executor.submit(self._prefetch, groups[0]))
+            pending = np.zeros(0, dtype=np.int64)
+            for g, group in enumerate(groups):
+                if executor is not None and g + 1 < len(groups):           # read while this group is consumed
+                    futures.append(executor.submit(self._prefetch, groups[g+1]))
+                idxs = np.concatenate([self.order[self.block_ptr[b] : self.block_ptr[b+1]] for b in group])
+                idxs = np.concatenate((pending, rng.permutation(idxs)))
+                n_full = len(idxs) // self.batch_size * self.batch_size
+                for start in range(0, n_full, self.batch_size):
+                    n_batches += 1
+                    yield idxs[start : start + self.batch_size].tolist()
+                pending = idxs[n_full:]
+            if len(pending) > 0 and not self.drop_last:
+                n_batches += 1
+                yield pending.tolist()
+        finally:
+            if executor is not None:                                        # (no cancel_futures before python 3.9)
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=True)
+        read_bytes = sum_over_processes(storage_read_bytes() - read_start)
+        self._log_epoch(epoch + 1, n_batches, read_bytes, time.time() - time_start)
+
+    def _log_epoch(self, epoch, n_batches, read_bytes, seconds):
+        if self.log_file is None:
+            return
+        needed_bytes = self.covered_hours * self.bytes_per_hour if self.bytes_per_hour is not None else None
+        amplification = f"{read_bytes / needed_bytes:.3f}" if needed_bytes else "n/a (input in memory)"
+        with open(self.log_file, 'a') as f:
+            f.write(f"\nBlock sampler, epoch {epoch}: {n_batches} batches from {len(self.blocks)} blocks of {self.block_hours} hours, "
+                f"{self.resident_blocks} resident; read {read_bytes / 2**20:.1f} MB from storage in {seconds:.1f} s, "
+                f"read amplification {amplification}.")
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.order) // self.batch_size
+        return (len(self.order) + self.batch_size - 1) // self.batch_size
+
+class Batch_buffers(object):
+    '''
+    A ring of preallocated (optionally pinned) float32 buffers for the input windows of a batch:
+    a buffer is reused n_buffers batches later, so a batch must have been consumed (used by the
+    model or copied to the device) by then; the default 3 leaves room for the batch prefetched by
+    the accelerate dataloader
+    '''
+    def __init__(self, window_shape, n_buffers=3, pin_memory=False):
+        self.window_shape = tuple(window_shape)
+        self.n_buffers = n_buffers
+        self.pin_memory = pin_memory
+        self.buffers = []
+        self.next = 0
+
+    def get(self, batch_size):
+        '''
+        Returns the next buffer, as a view of shape (batch_size,) + window_shape
+        '''
+        if len(self.buffers) == 0 or self.buffers[0].shape[0] < batch_size:      # (re)allocated for the largest batch
+            self.buffers = [torch.empty((batch_size,) + self.window_shape, pin_memory=self.pin_memory) for _ in range(self.n_buffers)]
+        buffer = self.buffers[self.next][:batch_size]
+        self.next = (self.next + 1) % self.n_buffers
+        return buffer
 
 class Dataset_pr(Dataset):
 
@@ -19,10 +501,218 @@ class Dataset_pr(Dataset):
         self.space_low_res_dim = self.lat_low_res_dim * self.lon_low_res_dim
         self.args = args
         self.length = None
+        self.group_by_time = getattr(args, 'sampler', None) == 'time'       # batches of Time_grouped_sampler
 
     def _load_data_into_memory(self):
         raise NotImplementedError
-    
+
+    def _load_input(self):
+        path = self.args.input_path + self.args.input_file
+        self.input_header = None
+        self.input_stats = None
+        self.var_major = False
+        if os.path.isdir(path):                                             # preprocessing_era5.py --store / --codec
+            with open(os.path.join(path, 'header.pkl'), 'rb') as f:
+                header = pickle.load(f)
+            if not header.get('standardized', True):                        # preprocessing_era5.py --no_standardize
+                stats_path = self.args.stats_path if self.args.stats_path is not None else self.args.input_path
+                self.input_stats = load_input_stats(stats_path, self.args.means_file, self.args.stds_file, len(header['params']))
+            if header['format'] == 'compressed':
+                self.input_header = header
+                input = Compressed_input(path, header, cache_chunks=self.args.cache_chunks)
+            else:
+                input, self.input_header = open_input_store(path)
+                self.var_major = header['layout'][0] == 'var'               # preprocessing_era5.py --layout var_major
+        elif path.endswith('.npy'):                                         # preprocessing_era5.py --streaming
+            input = np.load(path, mmap_mode='r')
+        else:
+            with open(path, 'rb') as f:
+                input = pickle.load(f)
+        return self._select_input(input)
+
+    def _select_input(self, input):
+        '''
+        Applies the --variables and --level_idxs selection: an in-memory input is reduced at
+        once, while for a memory-mapped or compressed input only the selected planes are read
+        by _get_window; in both cases the statistics of a raw store are reduced accordingly
+        '''
+        params = self.input_header['params'] if self.input_header is not None else ['q', 't', 'u', 'v', 'z']
+        n_levels = input.shape[1] if self.var_major else input.shape[2]
+        var_idxs, lev_idxs = select_variables_and_levels(params, n_levels, self.args.variables, self.args.level_idxs)
+        self.n_vars, self.n_levels = len(var_idxs), len(lev_idxs)
+        if self.input_stats is not None:
+            means, stds = self.input_stats
+            if means.shape[2] > 1:
+                means, stds = means[:, :, lev_idxs], stds[:, :, lev_idxs]
+            self.input_stats = (means[:, var_idxs], stds[:, var_idxs])
+        self.var_idxs, self.lev_idxs = slice(None), slice(None)             # everything selected
+        if self.n_vars == len(params) and self.n_levels == n_levels and (np.diff(var_idxs) > 0).all() and (np.diff(lev_idxs) > 0).all():
+            return input
+        if isinstance(input, torch.Tensor):                                 # in-memory input: keep only the selection
+            return input[:, var_idxs][:, :, lev_idxs].clone()
+        self.var_idxs, self.lev_idxs = var_idxs[:, None], lev_idxs[None, :]
+        return input
+
+    def _window_offsets(self):
+        '''
+        Prepares the gather of the windows of a batch: the input is seen as the (overlapping) runs
+        of 2*pad+2 contiguous elements starting at each position, and a window is made of the
+        25 x n_vars x n_levels x (2*pad+2) runs along lon at the returned offsets from its first
+        element; None if the input has no flat, contiguous storage (compressed store)
+        Returns:
+            offsets: int64 array of shape (25, n_vars, n_levels, 2*pad+2)
+            strides: the (time, var, lev, lat, lon) strides of the input, in elements
+            runs: tensor of shape (input size - 2*pad - 1, 2*pad+2), a view of the input
+        '''
+        if isinstance(self.input, torch.Tensor):
+            if not self.input.is_contiguous() or self.input.dtype != torch.float32:
+                return None
+            strides = list(self.input.stride())
+            flat = self.input.view(-1)
+        elif isinstance(self.input, np.ndarray) and self.input.flags.c_contiguous and self.input.itemsize in (2, 4):
+            strides = [stride // self.input.itemsize for stride in self.input.strides]
+            flat = self.input.reshape(-1).view(np.int16 if self.input.itemsize == 2 else np.float32)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')                             # read-only memory map, only read
+                flat = torch.from_numpy(flat)
+        else:
+            return None
+        if self.var_major:                                                  # (var, lev, time, lat, lon)
+            strides = [strides[2], strides[0], strides[1], strides[3], strides[4]]
+        side = 2 * self.pad + 2
+        var_idxs = np.arange(self.n_vars) if isinstance(self.var_idxs, slice) else self.var_idxs.ravel()
+        lev_idxs = np.arange(self.n_levels) if isinstance(self.lev_idxs, slice) else self.lev_idxs.ravel()
+        return window_offsets(strides, var_idxs, lev_idxs, side), strides, window_runs(flat, side, strides[4])
+
+    def _get_windows(self, time_idxs, lat_idxs, lon_idxs):
+        '''
+        Gathers the input windows of a batch of examples into the next buffer of the ring, with a
+        single index_select over the runs of the input when possible (same values as _get_window)
+        Arguments:
+            time_idxs, lat_idxs, lon_idxs: int arrays with the indexes of the examples
+        Returns:
+            tensor of shape (batch_size, 25, n_vars, n_levels, 6, 6)
+        '''
+        if not hasattr(self, 'batch_buffers'):
+            side = 2 * self.pad + 2
+            self.batch_buffers = Batch_buffers((25, self.n_vars, self.n_levels, side, side),
+                n_buffers=getattr(self.args, 'n_batch_buffers', 3), pin_memory=getattr(self.args, 'pin_memory', False))
+            self.window_offsets = self._window_offsets()
+        out = self.batch_buffers.get(len(time_idxs))
+        if self.group_by_time and not isinstance(self.input, torch.Tensor):  # a tensor in memory gains nothing from the blocks
+            return self._get_windows_by_time(time_idxs, lat_idxs, lon_idxs, out)
+        if self.window_offsets is None:                                     # one window at a time
+            for i, (time_idx, lat_idx, lon_idx) in enumerate(zip(time_idxs, lat_idxs, lon_idxs)):
+                out[i] = self._get_window(time_idx, lat_idx, lon_idx)
+            return out
+        offsets, strides, runs = self.window_offsets
+        starts = ((np.asarray(time_idxs) - 24) * strides[0] + (np.asarray(lat_idxs) - self.pad + 2) * strides[3]
+            + (np.asarray(lon_idxs) - self.pad + 2) * strides[4])
+        idxs = torch.from_numpy((starts[:, None] + offsets.reshape(1, -1)).reshape(-1))
+        if runs.dtype == torch.float32 and self.input_stats is None:
+            torch.index_select(runs, 0, idxs, out=out.view(-1, runs.shape[1]))
+            return out
+        window = torch.index_select(runs, 0, idxs).numpy().view(self.input.dtype).reshape(out.shape)
+        if self.input_header is not None and self.input_header.get('precision', 'float32') != 'float32':
+            window = upcast(window, self.input_header['precision'])
+        out_np = out.numpy()
+        if self.input_stats is not None:                                    # raw store, standardized into the buffer
+            np.subtract(window, self.input_stats[0][None], out=out_np)
+            np.divide(out_np, self.input_stats[1][None], out=out_np)
+        else:
+            out_np[...] = window
+        return out
+
+    def prefetch(self, time_start, time_stop):
+        '''
+        Reads the input of the time steps [time_start - 24, time_stop), so that it is in the page
+        cache when its examples are requested (called by Block_shuffle_sampler in a background
+        thread); nothing is done for an input in memory or a compressed store, whose chunk cache
+        is not shared between threads
+        '''
+        if not isinstance(self.input, np.ndarray):
+            return
+        t = slice(max(time_start - 24, 0), min(time_stop, self.input.shape[2 if self.var_major else 0]))
+        block = self.input[:, :, t] if self.var_major else self.input[t]
+        block.max(initial=0)
+
+    def input_bytes_per_hour(self):
+        '''
+        Returns the size in bytes of one hour of the input as stored, None for an input in memory
+        '''
+        if isinstance(self.input, Compressed_input):
+            return int(self.input.offsets[-1]) / self.input.shape[0]
+        if isinstance(self.input, np.ndarray):
+            return self.input.nbytes / self.input.shape[2 if self.var_major else 0]
+        return None
+
+    def example_time_idxs(self):
+        '''
+        Returns the time index of each example, as an int array
+        '''
+        return np.asarray(self.idx_to_key, dtype=np.int64) // self.space_low_res_dim
+
+    def _decode_keys(self, idxs):
+        '''
+        Returns the time, space, lat and lon indexes of a batch of examples, as int arrays
+        '''
+        keys = np.array([self.idx_to_key[idx] for idx in idxs], dtype=np.int64)
+        time_idxs = keys // self.space_low_res_dim
+        space_idxs = keys % self.space_low_res_dim
+        return time_idxs, space_idxs, space_idxs // self.lon_low_res_dim, space_idxs % self.lon_low_res_dim
+
+    def _get_window(self, time_idx, lat_idx, lon_idx):
+        lat_slice = slice(lat_idx - self.pad + 2, lat_idx + self.pad + 4)
+        lon_slice = slice(lon_idx - self.pad + 2, lon_idx + self.pad + 4)
+        return self._read(time_idx, lat_slice, lon_slice)
+
+    def _read(self, time_idx, lat_slice, lon_slice):
+        '''
+        Reads the 25 hours ending at time_idx of the given lat, lon slices of the input
+        Returns:
+            tensor of shape (25, n_vars, n_levels, lat, lon)
+        '''
+        if self.var_major:                                                  # (var, lev, time, lat, lon) store, read the selected planes only
+            window = self.input[self.var_idxs, self.lev_idxs, time_idx - 24 : time_idx+1, lat_slice, lon_slice].transpose(2, 0, 1, 3, 4)
+        else:
+            window = self.input[time_idx - 24 : time_idx+1, self.var_idxs, self.lev_idxs, lat_slice, lon_slice]
+
+        if isinstance(window, np.ndarray):                                  # memory-mapped input, read the window from disk
+            if self.input_header is not None and self.input_header.get('precision', 'float32') != 'float32':
+                window = upcast(window, self.input_header['precision'])
+            if self.input_stats is not None:                                # raw store, standardized here (the result is a new array)
+                window = (window - self.input_stats[0]) / self.input_stats[1]
+            else:
+                window = np.array(window)
+            window = torch.from_numpy(window)
+        return window
+
+    def _get_windows_by_time(self, time_idxs, lat_idxs, lon_idxs, out):
+        '''
+        Gathers the windows of a batch as _get_windows, but reads each distinct 25-hour block of
+        the batch once, as a few contiguous reads of the whole lat, lon extent, and cuts the windows
+        of all its cells from it (for a batch of Time_grouped_sampler)
+        '''
+        block_times, block_of = np.unique(time_idxs, return_inverse=True)
+        first = self._read(block_times[0], slice(None), slice(None))
+        blocks = torch.empty((len(block_times),) + tuple(first.shape))
+        blocks[0] = first
+        for b in range(1, len(block_times)):
+            blocks[b] = self._read(block_times[b], slice(None), slice(None))
+        side = out.shape[-1]
+        strides = blocks.stride()
+        offsets = window_offsets(strides[1:], np.arange(self.n_vars), np.arange(self.n_levels), side)
+        starts = (block_of * strides[0] + (np.asarray(lat_idxs) - self.pad + 2) * strides[4]
+            + (np.asarray(lon_idxs) - self.pad + 2) * strides[5])
+        idxs = torch.from_numpy((starts[:, None] + offsets.reshape(1, -1)).reshape(-1))
+        torch.index_select(window_runs(blocks.view(-1), side, strides[5]), 0, idxs, out=out.view(-1, side))
+        return out
+
+    def _get_subgraph(self, space_idx):
+        if isinstance(self.subgraphs, Subgraph_store):
+            return self.subgraphs[space_idx]                                # a new Data object
+        return self.subgraphs[space_idx].clone()
+
     def __len__(self):
         return self.length
 
@@ -33,23 +723,32 @@ class Dataset_pr_ae(Dataset_pr):
         self.input, self.idx_to_key = self._load_data_into_memory()
     
     def _load_data_into_memory(self):
-        with open(self.args.input_path + self.args.input_file, 'rb') as f:
-            input = pickle.load(f) 
+        input = self._load_input()
         with open(self.args.input_path + self.args.idx_file,'rb') as f:
             idx_to_key = pickle.load(f)
         self.length = len(idx_to_key)
         return input, idx_to_key
 
     def __getitem__(self, idx):
+        if isinstance(idx, list):                                           # indexes of a batch, from a batch sampler
+            return self._get_batch(idx)
         k = self.idx_to_key[idx]   
         time_idx = k // self.space_low_res_dim
         space_idx = k % self.space_low_res_dim
         lat_idx = space_idx // self.lon_low_res_dim
         lon_idx = space_idx % self.lon_low_res_dim
-        input = torch.zeros((25, 5, 5, 6, 6))
-        input[:] = self.input[time_idx - 24 : time_idx+1, :, :, lat_idx - self.pad + 2 : lat_idx + self.pad + 4, lon_idx - self.pad + 2 : lon_idx + self.pad + 4]
+        input = torch.zeros((25, self.n_vars, self.n_levels, 6, 6))
+        input[:] = self._get_window(time_idx, lat_idx, lon_idx)
         return input
 
+    def _get_batch(self, idxs):
+        '''
+        Returns the input of a whole batch, for the list of indexes given by a batch sampler
+        (DataLoader(dataset, sampler=batch_sampler, batch_size=None))
+        '''
+        time_idxs, _, lat_idxs, lon_idxs = self._decode_keys(idxs)
+        return self._get_windows(time_idxs, lat_idxs, lon_idxs)
+
 class Dataset_e(Dataset_pr_ae):
     
     def __getitem__(self, idx):
@@ -58,8 +757,8 @@ class Dataset_e(Dataset_pr_ae):
         space_idx = k[0]
         lat_idx = space_idx // self.lon_low_res_dim
         lon_idx = space_idx % self.lon_low_res_dim
-        input = torch.zeros((25, 5, 5, 6, 6))
-        input[:] = self.input[time_idx - 24 : time_idx+1, :, :, lat_idx - self.pad + 2 : lat_idx + self.pad + 4, lon_idx - self.pad + 2 : lon_idx + self.pad + 4]
+        input = torch.zeros((25, self.n_vars, self.n_levels, 6, 6))
+        input[:] = self._get_window(time_idx, lat_idx, lon_idx)
         return input, k 
 
 class Dataset_pr_gnn(Dataset_pr):
@@ -67,10 +766,10 @@ class Dataset_pr_gnn(Dataset_pr):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.input, self.idx_to_key, self.target, self.graph, self.subgraphs, self.mask_target = self._load_data_into_memory()
+        self.cell_tensors = Cell_tensors(self.subgraphs)
 
     def _load_data_into_memory(self):
-        with open(self.args.input_path + self.args.input_file, 'rb') as f:
-            input = pickle.load(f)
+        input = self._load_input()
         with open(self.args.input_path + self.args.idx_file,'rb') as f:
             idx_to_key = pickle.load(f)
         with open(self.args.input_path + self.args.target_file, 'rb') as f:
@@ -79,28 +778,68 @@ class Dataset_pr_gnn(Dataset_pr):
             graph = pickle.load(f)
         with open(self.args.input_path + self.args.mask_target_file, 'rb') as f:
             mask_target = pickle.load(f)
-        with open(self.args.input_path + self.args.subgraphs_file, 'rb') as f:
-            subgraphs = pickle.load(f)
+        subgraphs = load_subgraphs(self.args.input_path + self.args.subgraphs_file)
         self.length = len(idx_to_key)
         self.low_res_abs = abs(graph.low_res)
-        return input, idx_to_key, target, graph, subgraphs, mask_target
+        #-- node indexes of each cell, so that each example gathers one contiguous row of the targets
+        if isinstance(subgraphs, Subgraph_store):
+            self.cell_nodes = [subgraphs.nodes(s) for s in range(len(subgraphs))]
+        else:
+            self.cell_nodes = [torch.nonzero(subgraph.mask_1_cell).flatten().numpy().astype(np.int32) if isinstance(subgraph, Data) else None
+                for subgraph in subgraphs]
+        return input, idx_to_key, time_major_target(target), graph, subgraphs, time_major_mask(mask_target)
 
     def __getitem__(self, idx):
+        if isinstance(idx, list):                                           # indexes of a batch, from a batch sampler
+            return self._get_batch(idx)
         k = self.idx_to_key[idx]   
         time_idx = k // self.space_low_res_dim
         space_idx = k % self.space_low_res_dim
         lat_idx = space_idx // self.lon_low_res_dim
         lon_idx = space_idx % self.lon_low_res_dim
         #-- derive input
-        input = torch.zeros((25, 5, 5, 6, 6))                               # (time, var, lev, lat, lon)
-        input[:, :] = self.input[time_idx - 24 : time_idx+1, :, :, lat_idx - self.pad + 2 : lat_idx + self.pad + 4, lon_idx - self.pad + 2 : lon_idx + self.pad + 4]
-        #-- derive graphs and target
-        subgraph = self.subgraphs[space_idx].clone()
-        train_mask = self.mask_target[:,time_idx][subgraph.mask_1_cell]     # train_mask.shape = (self.graph.n_nodes, )
-        subgraph["train_mask"] = train_mask
-        y = self.target[subgraph.mask_1_cell, time_idx][train_mask]         # y.shape = (subgraph.n_nodes,)
-        subgraph["y"] = y 
-        return input, subgraph
+        input = torch.zeros((25, self.n_vars, self.n_levels, 6, 6))         # (time, var, lev, lat, lon)
+        input[:, :] = self._get_window(time_idx, lat_idx, lon_idx)
+        #-- derive target (the subgraph of the cell is added by collate)
+        train_mask, y = self._get_target(time_idx, space_idx)
+        return input, space_idx, train_mask, y
+
+    def _get_batch(self, idxs):
+        '''
+        Returns the collated batch, for the list of indexes given by a batch sampler
+        (DataLoader(dataset, sampler=batch_sampler, batch_size=None))
+        '''
+        time_idxs, space_idxs, lat_idxs, lon_idxs = self._decode_keys(idxs)
+        input = self._get_windows(time_idxs, lat_idxs, lon_idxs)
+        targets = [self._get_target(time_idx, space_idx) for time_idx, space_idx in zip(time_idxs, space_idxs)]
+        return input, self._batch_graphs(space_idxs, targets)
+
+    def _get_target(self, time_idx, space_idx):
+        nodes = self.cell_nodes[space_idx]
+        train_mask = unpack_mask_column(self.mask_target, time_idx, nodes)  # train_mask.shape = (subgraph.n_nodes, )
+        if isinstance(self.target, dict):                                   # sparse, time-major target
+            y = gather_sparse_column(self.target, time_idx, nodes[train_mask])
+        else:
+            y = self.target[time_idx, nodes[train_mask]]                    # y.shape = (train_mask.sum(),)
+        return train_mask, y
+
+    def _batch_graphs(self, space_idxs, targets):
+        data_batch = self.cell_tensors.batch(space_idxs)
+        data_batch.train_mask = torch.from_numpy(np.concatenate([train_mask for train_mask, _ in targets]))
+        data_batch.y = torch.from_numpy(np.concatenate([y for _, y in targets]))
+        return data_batch
+
+    def collate(self, batch):
+        '''
+        Collates the examples into the input tensor and one Batch of their subgraphs, built from
+        the cached tensors of the cells; only the train masks and targets are per example
+        '''
+        if isinstance(batch, tuple):                                        # already collated by _get_batch
+            return batch
+        input = torch.stack([item[0] for item in batch])                    # shape = (batch_size, 25, n_vars, n_levels, 6, 6)
+        data_batch = self._batch_graphs([item[1] for item in batch], [item[2:] for item in batch])
+        input = default_convert(input)
+        return input, data_batch
     
 class Dataset_pr_test(Dataset_pr):
 
@@ -111,41 +850,62 @@ class Dataset_pr_test(Dataset_pr):
         self.input, self.idx_to_key, self.subgraphs, self.test_graph = self._load_data_into_memory()
 
     def _load_data_into_memory(self):
-        with open(self.args.input_path + self.args.input_file, 'rb') as f:
-            input = pickle.load(f)
+        input = self._load_input()
         with open(self.args.input_path + self.args.idx_file,'rb') as f:
             idx_to_key = pickle.load(f)   
-        with open(self.args.input_path + self.args.subgraphs, 'rb') as f:
-            subgraphs = pickle.load(f)
+        subgraphs = load_subgraphs(self.args.input_path + self.args.subgraphs)
         with open(self.args.input_path + self.args.graph_file_test, 'rb') as f:
             test_graph = pickle.load(f)
         self.length = len(idx_to_key)
         return input, idx_to_key, subgraphs, test_graph
 
     def __getitem__(self, idx):
+        if isinstance(idx, list):                                           # indexes of a batch, from a batch sampler
+            return self._get_batch(idx)
         k = self.idx_to_key[idx]   
         time_idx = k // self.space_low_res_dim
         space_idx = k % self.space_low_res_dim
         lat_idx = space_idx // self.lon_low_res_dim
         lon_idx = space_idx % self.lon_low_res_dim
         #-- derive input
-        input = torch.zeros((25, 5, 5, 6, 6))                               # (time, var, lev, lat, lon)
-        input[:, :] = self.input[time_idx - 24 : time_idx+1, :, :, lat_idx - self.pad + 2 : lat_idx + self.pad + 4, lon_idx - self.pad + 2 : lon_idx + self.pad + 4]
+        input = torch.zeros((25, self.n_vars, self.n_levels, 6, 6))         # (time, var, lev, lat, lon)
+        input[:, :] = self._get_window(time_idx, lat_idx, lon_idx)
         #-- derive graphs and target
-        subgraph = self.subgraphs[space_idx].clone()
+        subgraph = self._get_subgraph(space_idx)
         subgraph["time_idx"] = time_idx - self.time_min
         y = self.test_graph.y[subgraph.mask_1_cell, time_idx - self.time_min]
         subgraph["y"] = y
         return input, subgraph
 
+    def _get_batch(self, idxs):
+        '''
+        Returns the collated batch, for the list of indexes given by a batch sampler
+        (DataLoader(dataset, sampler=batch_sampler, batch_size=None))
+        '''
+        time_idxs, space_idxs, lat_idxs, lon_idxs = self._decode_keys(idxs)
+        input = self._get_windows(time_idxs, lat_idxs, lon_idxs)
+        data = []
+        for time_idx, space_idx in zip(time_idxs, space_idxs):
+            subgraph = self._get_subgraph(space_idx)
+            subgraph["time_idx"] = int(time_idx) - self.time_min
+            subgraph["y"] = self.test_graph.y[subgraph.mask_1_cell, time_idx - self.time_min]
+            data.append(subgraph)
+        return input, data
+
 
 def custom_collate_fn_ae(batch):
+    if isinstance(batch, torch.Tensor):                                     # already gathered by _get_batch
+        return batch
     input = torch.stack(batch)
     input = default_convert(input)
     return input
 
 def custom_collate_fn_gnn(batch):
-    input = torch.stack([item[0] for item in batch])                        # shape = (batch_size, 25, 5, 5, 6, 6)
+    if isinstance(batch, tuple):                                            # already collated by _get_batch
+        return batch
+    if len(batch[0]) != 2:
+        raise TypeError("The items of Dataset_pr_gnn carry no subgraph, collate them with Dataset_pr_gnn.collate.")
+    input = torch.stack([item[0] for item in batch])                        # shape = (batch_size, 25, n_vars, n_levels, 6, 6)
     data = [item[1] for item in batch]
     input = default_convert(input)
     return input, data
@@ -32,6 +32,22 @@ parser.add_argument('--graph_file', type=str, default=None)
 parser.add_argument('--mask_target_file', type=str, default=None)
 parser.add_argument('--subgraphs_file', type=str, default=None)
 
+#-- input store
+parser.add_argument('--cache_chunks', type=int, default=64, help='number of decompressed chunks kept in memory for a compressed input store')
+parser.add_argument('--sampler', type=str, default='random', choices=['random', 'time', 'block'], help='random: shuffled examples; time: batches grouped by time index (Time_grouped_sampler), each 25-hour block of the input is read once; block: examples shuffled within groups of resident time blocks (Block_shuffle_sampler), for inputs larger than the memory')
+parser.add_argument('--seed', type=int, default=0, help='seed of the time and block samplers, the same in all the processes')
+parser.add_argument('--block_hours', type=int, default=168, help='hours per time block of the block sampler')
+parser.add_argument('--resident_blocks', type=int, default=8, help='number of time blocks shuffled together by the block sampler (the next as many are prefetched)')
+parser.add_argument('--n_batch_buffers', type=int, default=3, help='number of preallocated buffers the input windows of the batches are gathered into (reused in turn)')
+parser.add_argument('--pin_memory', action='store_true', help='pin the batch buffers, for faster copies to the gpu')
+parser.add_argument('--stats_path', type=str, default=None, help='path to the means and stds used to standardize a raw input store (default: input_path)')
+parser.add_argument('--means_file', type=str, default='means.pkl')
+parser.add_argument('--stds_file', type=str, default='stds.pkl')
+
+#-- input selection
+parser.add_argument('--variables', type=str, nargs='+', default=None, help='subset of the input variables (e.g. q t z), default all')
+parser.add_argument('--level_idxs', type=int, nargs='+', default=None, help='indexes of the subset of the pressure levels (at least 2), default all')
+
 #-- output files
 parser.add_argument('--log_file', type=str, default='log.txt', help='log file')
 parser.add_argument('--out_checkpoint_file', type=str, default="checkpoint.pth")
@@ -114,8 +130,17 @@ if __name__ == '__main__':
 #--------------- MODEL, LOSS, OPTIMIZER --------------
 #-----------------------------------------------------
 
+    #-- the encoder input follows the variables and levels selection
+    n_vars = len(args.variables) if args.variables is not None else 5
+    n_levels = len(args.level_idxs) if args.level_idxs is not None else 5
+    if n_levels < 2:
+        raise ValueError("The encoder needs at least 2 pressure levels.")
+
     Model = getattr(models, args.model_name)
-    model = Model()
+    if args.model_name == 'Autoencoder':
+        model = Model(input_size=n_vars, n_levels=n_levels)
+    else:
+        model = Model(input_size=n_vars)
     
     if args.mode == 'train':
 
@@ -147,15 +172,28 @@ if __name__ == '__main__':
 
     Dataset = getattr(dataset, 'Dataset_pr_'+dataset_type)
     custom_collate_fn = getattr(dataset, 'custom_collate_fn_'+collate_type)
+    Time_grouped_sampler = getattr(dataset, 'Time_grouped_sampler')
+    Block_shuffle_sampler = getattr(dataset, 'Block_shuffle_sampler')
 
     dataset = Dataset(args, lon_dim=args.lon_dim, lat_dim=args.lat_dim)
+    if hasattr(dataset, 'collate'):                                         # batches built from the cached subgraphs of the cells
+        custom_collate_fn = dataset.collate
 
     if accelerator is None or accelerator.is_main_process:
         with open(args.output_path+args.log_file, 'a') as f:
             f.write(f'\nTrainset size = {dataset.length}.')
 
     if args.mode == 'train':
-        dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=0, collate_fn=custom_collate_fn)
+        #-- the batch sampler gives the dataset the indexes of a whole batch (batch_size=None), which are gathered at once
+        if args.sampler == 'time':
+            batch_sampler = Time_grouped_sampler(dataset.example_time_idxs(), args.batch_size, shuffle=True, seed=args.seed)
+        elif args.sampler == 'block':
+            batch_sampler = Block_shuffle_sampler(dataset.example_time_idxs(), args.batch_size, block_hours=args.block_hours,
+                resident_blocks=args.resident_blocks, prefetch_fn=dataset.prefetch, seed=args.seed, bytes_per_hour=dataset.input_bytes_per_hour(),
+                log_file=args.output_path+args.log_file if accelerator is None or accelerator.is_main_process else None)
+        else:
+            batch_sampler = torch.utils.data.BatchSampler(torch.utils.data.RandomSampler(dataset), args.batch_size, drop_last=False)
+        dataloader = torch.utils.data.DataLoader(dataset, sampler=batch_sampler, batch_size=None, num_workers=0, collate_fn=custom_collate_fn)
     #elif args.mode == 'get_encoding':
     #    dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=0, collate_fn=custom_collate_fn)
 
@@ -232,6 +270,8 @@ if __name__ == '__main__':
     if accelerator is None or accelerator.is_main_process:
         with open(args.output_path+args.log_file, 'a') as f:
             f.write(f"\nCompleted in {end - start} seconds.")
+            if hasattr(dataset.input, 'cache_info'):
+                f.write(f"\nInput chunk cache: {dataset.input.cache_info()}")
             f.write(f"\nDONE!")
     
     if args.mode == 'train':
@@ -8,8 +8,36 @@ import sys
 import time
 import copy
 
+#-----------------------------------------------------
+#---------------- NODE FEATURES ----------------------
+#-----------------------------------------------------
+
+def batch_node_features(data_batch, encoding, node_dim, device):
+    '''
+    Appends to the node features of each subgraph the encoding of its example
+    Arguments:
+        data_batch: the Batch built by Dataset_pr_gnn.collate (with the batch vector mapping the
+            nodes to their example), or a list of Data (custom_collate_fn_gnn)
+        encoding: tensor of shape (batch_dim, encoding_dim)
+        node_dim: number of node features kept
+    Returns:
+        the Batch, with x of shape (n_nodes, node_dim + encoding_dim)
+    '''
+    if isinstance(data_batch, Batch):                                       # one gather over the nodes of the whole batch
+        data_batch = data_batch.to(device)
+        data_batch.x = torch.cat((data_batch.x[:,:node_dim].to(encoding.dtype), encoding[data_batch.batch]), dim=1)
+        return data_batch
+    for i, data in enumerate(data_batch):
+        data = data.to(device)
+        features = torch.zeros((data.num_nodes, node_dim + encoding.shape[1])).to(device)
+        features[:,:node_dim] = data.x[:,:node_dim]
+        features[:,node_dim:] = encoding[i,:]
+        data.__setitem__('x', features)
+    return Batch.from_data_list(data_batch, exclude_keys=["low_res", "mask_1_cell", "mask_subgraph", "idx_list", "idx_list_mapped"])
+
+
 class Autoencoder(nn.Module):
-    def __init__(self, input_size=5, gru_hidden_dim=12, cnn_output_dim=256, n_layers=2):
+    def __init__(self, input_size=5, gru_hidden_dim=12, cnn_output_dim=256, n_layers=2, n_levels=5):
         super().__init__() 
         self.cnn_output_dim = cnn_output_dim
         self.gru_hidden_dim = gru_hidden_dim
@@ -50,11 +78,11 @@ class Autoencoder(nn.Module):
             nn.ReLU(),
             nn.ConvTranspose3d(256, 64, kernel_size=3, padding=(1,1,1), stride=1),
             nn.ReLU(),
-            nn.Upsample(size=(5,6,6)),
+            nn.Upsample(size=(n_levels,6,6)),
             nn.ReLU(),
             nn.ConvTranspose3d(64, 64, kernel_size=3, padding=(1,1,1), stride=1),
             nn.ReLU(),
-            nn.ConvTranspose3d(64, 5, kernel_size=3, padding=(1,1,1), stride=1),
+            nn.ConvTranspose3d(64, input_size, kernel_size=3, padding=(1,1,1), stride=1),
             )
 
     def forward(self, X):
@@ -254,14 +282,7 @@ class Classifier_old(nn.Module):
         encoding = encoding.reshape(s[0], s[1]*self.cnn_output_dim)         # (batch_dim, 25*gru_hidden_dim)
         encoding = self.dense(encoding)
 
-        for i, data in enumerate(data_batch):
-            data = data.to(device)
-            features = torch.zeros((data.num_nodes, 3 + encoding.shape[1])).to(device)
-            features[:,:3] = data.x[:,:3]
-            features[:,3:] = encoding[i,:]
-            data.__setitem__('x', features)
-            
-        data_batch = Batch.from_data_list(data_batch, exclude_keys=["low_res", "mask_1_cell", "mask_subgraph", "idx_list", "idx_list_mapped"]) 
+        data_batch = batch_node_features(data_batch, encoding, 3, device)
         y_pred = self.gnn(data_batch.x, data_batch.edge_index) 
         train_mask = data_batch.train_mask
         return y_pred.squeeze()[train_mask], data_batch.y.squeeze()     
@@ -318,14 +339,7 @@ class Regressor_old(nn.Module):
         encoding = encoding.reshape(s[0], s[1]*self.cnn_output_dim)         # (batch_dim, 25*gru_hidden_dim)
         encoding = self.dense(encoding)
 
-        for i, data in enumerate(data_batch):
-            data = data.to(device)
-            features = torch.zeros((data.num_nodes, 3 + encoding.shape[1])).to(device)
-            features[:,:3] = data.x[:,:3]
-            features[:,3:] = encoding[i,:]
-            data.__setitem__('x', features)
-            
-        data_batch = Batch.from_data_list(data_batch, exclude_keys=["low_res", "mask_1_cell", "mask_subgraph", "idx_list", "idx_list_mapped"]) 
+        data_batch = batch_node_features(data_batch, encoding, 3, device)
         y_pred = self.gnn(data_batch.x, data_batch.edge_index)
         train_mask = data_batch.train_mask
         return y_pred.squeeze()[train_mask], data_batch.y.squeeze()
@@ -387,14 +401,7 @@ class Classifier_z_only(nn.Module):
         encoding = encoding.reshape(s[0], s[1]*self.cnn_output_dim)         # (batch_dim, 25*gru_hidden_dim)
         encoding = self.dense(encoding)
 
-        for i, data in enumerate(data_batch):
-            data = data.to(device)
-            features = torch.zeros((data.num_nodes, self.node_dim + encoding.shape[1])).to(device)
-            features[:,:self.node_dim] = data.x[:,:self.node_dim]
-            features[:,self.node_dim:] = encoding[i,:]
-            data.__setitem__('x', features)
-            
-        data_batch = Batch.from_data_list(data_batch, exclude_keys=["low_res", "mask_1_cell", "mask_subgraph", "idx_list", "idx_list_mapped"]) 
+        data_batch = batch_node_features(data_batch, encoding, self.node_dim, device)
         y_pred = self.gnn(data_batch.x, data_batch.edge_index) 
         train_mask = data_batch.train_mask
         return y_pred.squeeze()[train_mask], data_batch.y.squeeze()     
@@ -452,14 +459,7 @@ class Regressor_z_only(nn.Module):
         encoding = encoding.reshape(s[0], s[1]*self.cnn_output_dim)         # (batch_dim, 25*gru_hidden_dim)
         encoding = self.dense(encoding)
 
-        for i, data in enumerate(data_batch):
-            data = data.to(device)
-            features = torch.zeros((data.num_nodes, self.node_dim + encoding.shape[1])).to(device)
-            features[:,:self.node_dim] = data.x[:,:self.node_dim]
-            features[:,self.node_dim:] = encoding[i,:]
-            data.__setitem__('x', features)
-            
-        data_batch = Batch.from_data_list(data_batch, exclude_keys=["low_res", "mask_1_cell", "mask_subgraph", "idx_list", "idx_list_mapped"]) 
+        data_batch = batch_node_features(data_batch, encoding, self.node_dim, device)
         y_pred = self.gnn(data_batch.x, data_batch.edge_index, data_batch.edge_attr.float())
         train_mask = data_batch.train_mask
         return y_pred.squeeze()[train_mask], data_batch.y.squeeze()
@@ -523,14 +523,7 @@ class Classifier_edges(nn.Module):
         encoding = encoding.reshape(s[0], s[1]*self.cnn_output_dim)         # (batch_dim, 25*gru_hidden_dim)
         encoding = self.dense(encoding)
 
-        for i, data in enumerate(data_batch):
-            data = data.to(device)
-            features = torch.zeros((data.num_nodes, self.node_dim + encoding.shape[1])).to(device)
-            features[:,:self.node_dim] = data.x[:,:self.node_dim]
-            features[:,self.node_dim:] = encoding[i,:]
-            data.__setitem__('x', features)
-            
-        data_batch = Batch.from_data_list(data_batch, exclude_keys=["low_res", "mask_1_cell", "mask_subgraph", "idx_list", "idx_list_mapped"]) 
+        data_batch = batch_node_features(data_batch, encoding, self.node_dim, device)
         y_pred = self.gnn(data_batch.x, data_batch.edge_index, data_batch.edge_attr.float()) 
         train_mask = data_batch.train_mask
         return y_pred.squeeze()[train_mask], data_batch.y.squeeze()     
@@ -589,14 +582,7 @@ class Regressor_edges(nn.Module):
         encoding = encoding.reshape(s[0], s[1]*self.cnn_output_dim)         # (batch_dim, 25*gru_hidden_dim)
         encoding = self.dense(encoding)
 
-        for i, data in enumerate(data_batch):
-            data = data.to(device)
-            features = torch.zeros((data.num_nodes, self.node_dim + encoding.shape[1])).to(device)
-            features[:,:self.node_dim] = data.x[:,:self.node_dim]
-            features[:,self.node_dim:] = encoding[i,:]
-            data.__setitem__('x', features)
-            
-        data_batch = Batch.from_data_list(data_batch, exclude_keys=["low_res", "mask_1_cell", "mask_subgraph", "idx_list", "idx_list_mapped"]) 
+        data_batch = batch_node_features(data_batch, encoding, self.node_dim, device)
         y_pred = self.gnn(data_batch.x, data_batch.edge_index, data_batch.edge_attr.float())
         train_mask = data_batch.train_mask
         return y_pred.squeeze()[train_mask], data_batch.y.squeeze()
@@ -665,8 +651,8 @@ class Regressor_edges(nn.Module):
 
 class Classifier_old_test(Classifier_old):
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
     
     def forward(self, X, data_list, G_test, device):
         s = X.shape
@@ -695,8 +681,8 @@ class Classifier_old_test(Classifier_old):
 
 class Regressor_old_test(Regressor_old):
     
-    def __init__(self):
-        super().__init__()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
     
     def forward(self, X, data_list, G_test, device):
         s = X.shape
@@ -728,8 +714,8 @@ class Regressor_old_test(Regressor_old):
 
 class Classifier_z_only_test(Classifier_z_only):
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
 
     def forward(self, X_batch, data_list, G_test, device):
         s = X_batch.shape
@@ -759,8 +745,8 @@ class Classifier_z_only_test(Classifier_z_only):
 
 class Regressor_z_only_test(Regressor_z_only):
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
     
     def forward(self, X_batch, data_list, G_test, device):
         s = X_batch.shape
@@ -795,8 +781,8 @@ class Regressor_z_only_test(Regressor_z_only):
 
 class Classifier_edges_test(Classifier_edges):
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
 
     def forward(self, X_batch, data_list, G_test, device):
         s = X_batch.shape
@@ -826,8 +812,8 @@ class Classifier_edges_test(Classifier_edges):
 
 class Regressor_edges_test(Regressor_edges):
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
     
     def forward(self, X_batch, data_list, G_test, device):
         s = X_batch.shape
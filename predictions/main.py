@@ -30,6 +30,19 @@ parser.add_argument('--checkpoint_cl', type=str)
 parser.add_argument('--checkpoint_reg', type=str)
 parser.add_argument('--output_file', type=str, default="G_predictions_2016.pkl")
 
+#-- input store
+parser.add_argument('--cache_chunks', type=int, default=64, help='number of decompressed chunks kept in memory for a compressed input store')
+parser.add_argument('--sampler', type=str, default='sequential', choices=['sequential', 'time'], help='sequential: examples in order; time: batches grouped by time index (Time_grouped_sampler), each 25-hour block of the input is read once')
+parser.add_argument('--n_batch_buffers', type=int, default=3, help='number of preallocated buffers the input windows of the batches are gathered into (reused in turn)')
+parser.add_argument('--pin_memory', action='store_true', help='pin the batch buffers, for faster copies to the gpu')
+parser.add_argument('--stats_path', type=str, default=None, help='path to the means and stds used to standardize a raw input store (default: input_path)')
+parser.add_argument('--means_file', type=str, default='means.pkl')
+parser.add_argument('--stds_file', type=str, default='stds.pkl')
+
+#-- input selection
+parser.add_argument('--variables', type=str, nargs='+', default=None, help='subset of the input variables (e.g. q t z), default all')
+parser.add_argument('--level_idxs', type=int, nargs='+', default=None, help='indexes of the subset of the pressure levels (at least 2), default all')
+
 #-- output files
 parser.add_argument('--log_file', type=str, default='log.txt', help='log file')
 
@@ -79,14 +92,26 @@ if __name__ == '__main__':
 #----------------- DATASET AND MODELS ----------------
 #-----------------------------------------------------
 
+    #-- the encoder input follows the variables and levels selection
+    n_vars = len(args.variables) if args.variables is not None else 5
+    n_levels = len(args.level_idxs) if args.level_idxs is not None else 5
+    if n_levels < 2:
+        raise ValueError("The encoder needs at least 2 pressure levels.")
+
     Dataset = getattr(dataset, 'Dataset_pr_test')
     custom_collate_fn = getattr(dataset, 'custom_collate_fn_gnn')
+    Time_grouped_sampler = getattr(dataset, 'Time_grouped_sampler')
     
     with open(args.output_path + args.log_file, 'a') as f:
         f.write("\nBuilding the dataset and the dataloader.")
 
     dataset = Dataset(args=args, lon_dim=args.lon_dim, lat_dim=args.lat_dim, time_min=args.idx_min, time_max=140255) #time_min=113951, time_max=140255)
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=0, collate_fn=custom_collate_fn)
+    #-- the batch sampler gives the dataset the indexes of a whole batch (batch_size=None), which are gathered at once
+    if args.sampler == 'time':
+        batch_sampler = Time_grouped_sampler(dataset.example_time_idxs(), args.batch_size, shuffle=False)
+    else:
+        batch_sampler = torch.utils.data.BatchSampler(torch.utils.data.SequentialSampler(dataset), args.batch_size, drop_last=False)
+    dataloader = torch.utils.data.DataLoader(dataset, sampler=batch_sampler, batch_size=None, num_workers=0, collate_fn=custom_collate_fn)
 
     with open(args.output_path + args.log_file, 'a') as f:
         f.write("\nDone!")
@@ -95,8 +120,8 @@ if __name__ == '__main__':
     Model_cl = getattr(models, args.model_name_cl)
     Model_reg = getattr(models, args.model_name_reg)
 
-    model_cl = Model_cl()
-    model_reg = Model_reg()
+    model_cl = Model_cl(input_size=n_vars)
+    model_reg = Model_reg(input_size=n_vars)
 
     with open(args.output_path + args.log_file, 'a') as f:
         f.write("\nClassifier:")
@@ -129,6 +154,8 @@ if __name__ == '__main__':
 
     with open(args.output_path + args.log_file, 'a') as f:
         f.write(f"\nDone. Testing concluded in {end-start} seconds.")
+        if hasattr(dataset.input, 'cache_info'):
+            f.write(f"\nInput chunk cache: {dataset.input.cache_info()}")
         f.write("\nWrite the files.")
 
     with open(args.output_path + args.output_file, 'wb') as f:
@@ -1,6 +1,10 @@
 import numpy as np
 import pickle
 import sys
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
 
 import torch
 from torch.utils.data import Dataset
@@ -8,6 +12,8 @@ from torch.utils.data._utils.collate import default_convert
 
 from torch_geometric.data import Data
 
+import utils_graph
+
 import argparse
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
@@ -15,7 +21,7 @@ parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFo
 parser.add_argument('--input_path', type=str) #, default="/m100_work/ICT23_ESP_C/vblasone/DATA/graph/")
 parser.add_argument('--output_path', type=str) #, default="/m100_work/ICT23_ESP_C/vblasone/DATA/graph/")
 parser.add_argument('--graph_file', type=str) #, default="G_north_italy_train_all.pkl")
-parser.add_argument('--subgraphs_file', type=str) #, default="subgraphs_s.pkl")
+parser.add_argument('--subgraphs_file', type=str, help='directory of the subgraph store (or pickle file with --legacy_pickle)') #, default="subgraphs_s.pkl")
 parser.add_argument('--space_idxs_file', type=str) #, default="valid_examples_space.pkl")
 parser.add_argument('--mask_1_cell_file', type=str) #, default="mask_1_cell_subgraphs.pkl")
 parser.add_argument('--mask_9_cells_file', type=str) 
@@ -23,6 +29,66 @@ parser.add_argument('--mask_9_cells_file', type=str)
 # other
 parser.add_argument('--lat_dim', type=int) #, default=16)
 parser.add_argument('--lon_dim', type=int) #, default=31)
+parser.add_argument('--n_workers', type=int, default=1, help='number of processes building the subgraphs (each one a block of cells)')
+parser.add_argument('--legacy_pickle', action='store_true', help='write the pickled list of torch_geometric Data objects instead of the store')
+
+def mask_row(mask, space_idx):
+    '''
+    Returns the (n_nodes,) boolean mask of a cell, from either the CSR masks written by
+    preprocessing_graphs_and_targets.py or the older dense (n_cells, n_nodes) tensors
+    '''
+    if isinstance(mask, dict):
+        return torch.tensor(utils_graph.csr_row_mask(mask, space_idx))
+    return mask[space_idx].cpu()
+
+def cells_csr(mask, space_idxs, n_cells):
+    '''
+    Returns the CSR mask (see utils_graph.py) with the nodes of the cells in space_idxs,
+    the other rows being empty, from either mask format
+    '''
+    if isinstance(mask, dict):
+        rows = np.repeat(np.arange(len(mask['indptr']) - 1), np.diff(mask['indptr']))
+        cols, n_nodes = mask['indices'], mask['n_nodes']
+    else:
+        rows, cols = np.nonzero(mask.cpu().numpy())
+        n_nodes = mask.shape[1]
+    keep = np.logical_and(np.isin(rows, space_idxs), rows < n_cells)
+    return utils_graph.csr_from_pairs(rows[keep], cols[keep], n_cells, n_nodes)
+
+def block_subgraphs(csr, edge_index, first, last):
+    '''
+    Induced subgraphs of the rows first:last of a CSR mask (the task of one process)
+    '''
+    indptr = csr['indptr'][first:last+1]
+    block = {'indptr': indptr - indptr[0], 'indices': csr['indices'][indptr[0]:indptr[-1]], 'n_nodes': csr['n_nodes']}
+    return utils_graph.induced_subgraphs(block, edge_index)
+
+#-----------------------------------------------------
+#------------------ SUBGRAPH STORE -------------------
+#-----------------------------------------------------
+
+## The subgraphs are written as a directory of .npy files (memory-mappable) and a header:
+##   node_ptr, node_ids: the (sorted) graph nodes of cell s are node_ids[node_ptr[s]:node_ptr[s+1]]
+##   nodes_9_ptr, nodes_9_ids: the same for the nodes of the 9 cells around s
+##   edge_ptr, edge_index, edge_attr: the edges of the subgraph of cell s are the columns
+##       edge_ptr[s]:edge_ptr[s+1] of edge_index (relabeled to the positions in the cell nodes)
+##   x, low_res: the node features of the whole graph, gathered with the cell nodes
+## The cells without a subgraph have no nodes.
+
+def write_subgraph_store(path, graph, nodes_1, nodes_9, edge_ptr, edge_ids, local_edge_index, space_idxs):
+    os.makedirs(path, exist_ok=True)
+    arrays = {'node_ptr': nodes_1['indptr'], 'node_ids': nodes_1['indices'].astype(np.int32),
+        'nodes_9_ptr': nodes_9['indptr'], 'nodes_9_ids': nodes_9['indices'].astype(np.int32),
+        'edge_ptr': edge_ptr, 'edge_index': local_edge_index.astype(np.int32),
+        'x': graph.x.numpy(), 'low_res': graph.low_res.numpy()}
+    if graph.edge_attr is not None:
+        arrays['edge_attr'] = graph.edge_attr.numpy()[edge_ids]
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(array))
+    header = {'format': 'subgraph_store', 'n_cells': len(edge_ptr) - 1, 'n_nodes': nodes_1['n_nodes'],
+        'cells': np.asarray(space_idxs), 'arrays': list(arrays)}
+    with open(os.path.join(path, 'header.pkl'), 'wb') as f:
+        pickle.dump(header, f)
 
 if __name__ == "__main__":
 
@@ -42,27 +108,53 @@ if __name__ == "__main__":
     with open(args.input_path + args.mask_9_cells_file, 'rb') as f:
         mask_9_cells = pickle.load(f)
     
-    subgraphs = [[] for i in range(max(space_idxs)+1)]
-
-    for space_idx in space_idxs:
-        lat_idx = space_idx // args.lon_dim
-        lon_idx = space_idx % args.lon_dim
-        mask_subgraph = mask_1_cell[space_idx] # shape = (n_nodes,)
-        subgraph = graph.subgraph(subset=mask_subgraph)
-        cell_idx_list = torch.tensor([ii * args.lon_dim + jj for ii in range(lat_idx-1,lat_idx+2) for jj in range(lon_idx-1,lon_idx+2)])
-        #idx_list_mapped = torch.sum(torch.stack([(subgraph.low_res==idx)* j for j, idx in enumerate(cell_idx_list)]), dim=0)
-        subgraph["mask_1_cell"] = mask_1_cell[space_idx].cpu()  # (n_nodes)
-        subgraph["mask_9_cells"] = mask_9_cells[space_idx].cpu()         # (n_nodes)
-        #subgraph["idx_list"] = cell_idx_list
-        #subgraph["idx_list_mapped"] = idx_list_mapped
-        #subgraphs[space_idx] = subgraph
-        #s = dict()
-        #for a in subgraph:
-        #    s[a[0]] = a[1]
-        subgraphs[space_idx] = subgraph
-
-        if space_idx % 10 == 0:
-            print(f"Done until {space_idx}.")
+    if not args.legacy_pickle:
+
+        ## all the subgraphs in one pass over the edge list, split in blocks of cells
+        start = time.time()
+        n_cells = max(space_idxs) + 1
+        nodes_1 = cells_csr(mask_1_cell, space_idxs, n_cells)
+        nodes_9 = cells_csr(mask_9_cells, space_idxs, n_cells)
+        edge_index = graph.edge_index.numpy()
+        n_blocks = max(args.n_workers, 1)
+        bounds = np.linspace(0, n_cells, n_blocks + 1).astype(int)
+        if n_blocks > 1:
+            with ProcessPoolExecutor(max_workers=n_blocks) as pool:
+                blocks = list(pool.map(block_subgraphs, [nodes_1] * n_blocks, [edge_index] * n_blocks, bounds[:-1], bounds[1:]))
+        else:
+            blocks = [block_subgraphs(nodes_1, edge_index, 0, n_cells)]
+        edge_ptr = [np.zeros(1, dtype=np.int64)]
+        for block_edge_ptr, _, _ in blocks:
+            edge_ptr.append(block_edge_ptr[1:] + edge_ptr[-1][-1])
+        edge_ptr = np.concatenate(edge_ptr)
+        edge_ids = np.concatenate([b[1] for b in blocks])
+        local_edge_index = np.concatenate([b[2] for b in blocks], axis=1)
+        write_subgraph_store(args.output_path + args.subgraphs_file, graph, nodes_1, nodes_9, edge_ptr, edge_ids, local_edge_index, space_idxs)
+        print(f"Wrote the subgraphs of {len(space_idxs)} cells ({len(edge_ids)} edges) in {time.time() - start:.2f} s.")
+
+    else:
+        ## legacy format: a list with the torch_geometric Data object of each cell
+        subgraphs = [[] for i in range(max(space_idxs)+1)]
+
+        for space_idx in space_idxs:
+            lat_idx = space_idx // args.lon_dim
+            lon_idx = space_idx % args.lon_dim
+            mask_subgraph = mask_row(mask_1_cell, space_idx) # shape = (n_nodes,)
+            subgraph = graph.subgraph(subset=mask_subgraph)
+            cell_idx_list = torch.tensor([ii * args.lon_dim + jj for ii in range(lat_idx-1,lat_idx+2) for jj in range(lon_idx-1,lon_idx+2)])
+            #idx_list_mapped = torch.sum(torch.stack([(subgraph.low_res==idx)* j for j, idx in enumerate(cell_idx_list)]), dim=0)
+            subgraph["mask_1_cell"] = mask_subgraph                 # (n_nodes)
+            subgraph["mask_9_cells"] = mask_row(mask_9_cells, space_idx)    # (n_nodes)
+            #subgraph["idx_list"] = cell_idx_list
+            #subgraph["idx_list_mapped"] = idx_list_mapped
+            #subgraphs[space_idx] = subgraph
+            #s = dict()
+            #for a in subgraph:
+            #    s[a[0]] = a[1]
+            subgraphs[space_idx] = subgraph
+
+            if space_idx % 10 == 0:
+                print(f"Done until {space_idx}.")
     
-    with open(args.output_path + args.subgraphs_file, 'wb') as f:
-        pickle.dump(subgraphs, f)
+        with open(args.output_path + args.subgraphs_file, 'wb') as f:
+            pickle.dump(subgraphs, f)
@@ -0,0 +1,308 @@
+import numpy as np
+import argparse
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+#-- paths
+parser.add_argument('--output_path', type=str, required=True, help='directory where the outputs of the requested stages are restored')
+parser.add_argument('--cache_path', type=str, default=None, help='directory of the stage cache (default: output_path/cache/)')
+parser.add_argument('--log_file', type=str, default='log_pipeline.txt')
+parser.add_argument('--input_path', type=str, default='/m100_work/ICT23_ESP_C/vblasone/NORTH_ITALY/', help='directory of the ERA5 input files')
+parser.add_argument('--target_path_file', type=str, default='/m100_work/ICT23_ESP_C/vblasone/GRIPHO/gripho-v1_1h_TSmin30pct_2001-2016_cut.nc')
+parser.add_argument('--topo_path_file', type=str, default='/m100_work/ICT23_ESP_C/vblasone/TOPO/GMTED_DEM_30s_remapdis_GRIPHO.nc')
+
+#-- parameters of the stages
+parser.add_argument('--era5_args', type=str, default='', help='other arguments passed as they are to preprocessing_era5.py (e.g. "--store --n_workers 4")')
+parser.add_argument('--lon_min', type=float, default=6.50)
+parser.add_argument('--lon_max', type=float, default=14.25)
+parser.add_argument('--lat_min', type=float, default=43.50)
+parser.add_argument('--lat_max', type=float, default=47.50)
+parser.add_argument('--interval', type=float, default=0.25)
+parser.add_argument('--offset_9_cells', type=float, default=0.25)
+parser.add_argument('--split_file', type=str, default=None)
+parser.add_argument('--threshold', type=float, default=0.1)
+parser.add_argument('--dense_reg_target', action='store_true')
+parser.add_argument('--suffix', type=str, default='')
+parser.add_argument('--time_chunk', type=int, default=8760, help='not part of the cache keys, it does not change the outputs')
+parser.add_argument('--n_read_workers', type=int, default=1, help='not part of the cache keys, it does not change the outputs')
+
+#-- runner
+parser.add_argument('--stages', type=str, nargs='+', default=None, help='stages to bring up to date, with the stages they depend on (default: all)')
+parser.add_argument('--force', type=str, nargs='+', default=[], help='stages to run even if their outputs are in the cache')
+parser.add_argument('--n_jobs', type=int, default=2, help='maximum number of stages running at the same time')
+parser.add_argument('--link', action='store_true', help='restore the outputs as hard links to the cache instead of copies '+
+    '(the hard links share the data with the cache, so rewriting them in place corrupts the cache)')
+parser.add_argument('--dry_run', action='store_true', help='only print the stages that would run')
+
+#-----------------------------------------------------
+#---------------------- STAGES -----------------------
+#-----------------------------------------------------
+
+## The stages of the preprocessing, in topological order. Each stage runs one script in its
+## own directory, where the outputs of the stages it depends on are linked, and its outputs
+## (all the new files) are kept in the cache under a key that hashes the stage parameters,
+## the scripts source, a fingerprint of the external input files and the keys of the stages
+## it depends on. A stage whose key is already in the cache is not run again: e.g. changing
+## the threshold only rebuilds the targets and indexes stages.
+
+PREPROCESSING_PATH = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = {
+    'era5':      {'script': 'preprocessing_era5.py',             'deps': []},
+    'cells':     {'script': 'preprocessing_graphs_and_targets.py', 'deps': []},
+    'graph':     {'script': 'preprocessing_graphs_and_targets.py', 'deps': ['cells']},
+    'targets':   {'script': 'preprocessing_graphs_and_targets.py', 'deps': ['cells']},
+    'indexes':   {'script': 'preprocessing_graphs_and_targets.py', 'deps': ['cells', 'targets']},
+    'subgraphs': {'script': 'make_subgraphs_single.py',          'deps': ['cells', 'graph']},
+    }
+
+## the stages run in the directory the pipeline is launched from, where
+## preprocessing_graphs_and_targets.py reads the file with the statistics of lat, lon and z
+WORKING_PATH = os.getcwd()
+LAT_LON_Z_FILE = os.path.join(WORKING_PATH, 'lat_lon_z_best.pkl')
+
+## options of preprocessing_era5.py naming the statistics it loads with --load_stats (same defaults)
+era5_stats_parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+era5_stats_parser.add_argument('--load_stats', action='store_true')
+era5_stats_parser.add_argument('--stats_path', type=str, default='/m100_work/ICT23_ESP_C/vblasone/NORTH_ITALY/north_italy/')
+era5_stats_parser.add_argument('--means_file', type=str, default='means.pkl')
+era5_stats_parser.add_argument('--stds_file', type=str, default='stds.pkl')
+
+def write_log(s, args, mode='a'):
+    with open(args.output_path + args.log_file, mode) as f:
+        f.write(s)
+
+def low_res_dims(args):
+    lon_low_res_dim = np.arange(args.lon_min, args.lon_max, args.interval).shape[0]
+    lat_low_res_dim = np.arange(args.lat_min, args.lat_max, args.interval).shape[0]
+    return lat_low_res_dim, lon_low_res_dim
+
+def stage_params(name, args):
+    '''
+    Returns the arguments of a stage that determine its outputs (part of the cache key)
+    '''
+    if name == 'era5':
+        return ['--input_path', args.input_path] + shlex.split(args.era5_args)
+    if name == 'subgraphs':
+        lat_dim, lon_dim = low_res_dims(args)
+        return ['--graph_file', f'G_train{args.suffix}.pkl', '--subgraphs_file', f'subgraphs{args.suffix}',
+            '--space_idxs_file', 'valid_examples_space.pkl', '--mask_1_cell_file', f'mask_1_cell_subgraphs{args.suffix}.pkl',
+            '--mask_9_cells_file', f'mask_9_cells_subgraphs{args.suffix}.pkl', '--lat_dim', str(lat_dim), '--lon_dim', str(lon_dim)]
+    params = ['--stage', name, '--target_path_file', args.target_path_file, '--topo_path_file', args.topo_path_file,
+        '--lon_min', str(args.lon_min), '--lon_max', str(args.lon_max), '--lat_min', str(args.lat_min), '--lat_max', str(args.lat_max),
+        '--interval', str(args.interval), '--offset_9_cells', str(args.offset_9_cells), '--suffix', args.suffix]
+    if args.split_file is not None:
+        params += ['--split_file', args.split_file]
+    if name == 'targets':
+        params += ['--threshold', str(args.threshold)] + (['--dense_reg_target'] if args.dense_reg_target else [])
+    return params
+
+def stage_runtime_args(name, args, work_path):
+    '''
+    Returns the arguments of a stage that do not change its outputs (not part of the cache key)
+    '''
+    if name == 'era5':
+        return ['--output_path', work_path, '--log_file', 'log_era5.txt']
+    if name == 'subgraphs':
+        return ['--input_path', work_path, '--output_path', work_path]
+    return ['--output_path', work_path, '--log_file', f'log_{name}.txt', '--time_chunk', str(args.time_chunk),
+        '--n_read_workers', str(args.n_read_workers)]
+
+def stage_inputs(name, args):
+    '''
+    Returns the external files (or directories) read by a stage
+    '''
+    if name == 'era5':
+        era5_args, _ = era5_stats_parser.parse_known_args(shlex.split(args.era5_args))
+        if era5_args.load_stats:
+            return [args.input_path, era5_args.stats_path + era5_args.means_file, era5_args.stats_path + era5_args.stds_file]
+        return [args.input_path]
+    if name == 'subgraphs':
+        return []
+    inputs = [args.target_path_file] + ([args.split_file] if args.split_file is not None else [])
+    if name == 'cells':
+        inputs.append(args.topo_path_file)
+    if name == 'graph':
+        inputs.append(LAT_LON_Z_FILE)
+    return inputs
+
+#-----------------------------------------------------
+#-------------------- CACHE KEYS ---------------------
+#-----------------------------------------------------
+
+def fingerprint(path):
+    '''
+    Fingerprints a file, or the files of a directory, by path, size and modification time
+    (hashing the contents of the input files would mean reading them at every run)
+    '''
+    path = os.path.abspath(path)
+    if not os.path.exists(path):
+        return [path, None]
+    if os.path.isdir(path):
+        return [fingerprint(os.path.join(path, f)) for f in sorted(os.listdir(path))]
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+def code_hash(script):
+    '''
+    Hashes the source of a script and of the utils modules it can import
+    '''
+    h = hashlib.sha256()
+    for f in [script] + sorted(f for f in os.listdir(PREPROCESSING_PATH) if f.startswith('utils_') and f.endswith('.py')):
+        with open(os.path.join(PREPROCESSING_PATH, f), 'rb') as source:
+            h.update(f.encode() + source.read())
+    return h.hexdigest()
+
+def stage_keys(args):
+    '''
+    Computes the cache key of each stage, after the keys of the stages it depends on
+    '''
+    keys = dict()
+    for name, stage in STAGES.items():
+        content = {'stage': name, 'code': code_hash(stage['script']), 'params': stage_params(name, args),
+            'inputs': [fingerprint(p) for p in stage_inputs(name, args)], 'deps': {d: keys[d] for d in stage['deps']}}
+        keys[name] = hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()[:16]
+    return keys
+
+#-----------------------------------------------------
+#------------------- RUN AND RESTORE -----------------
+#-----------------------------------------------------
+
+def link_or_copy(src, dst, copy=False):
+    if os.path.isdir(dst):
+        shutil.rmtree(dst)
+    elif os.path.lexists(dst):
+        os.remove(dst)
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, copy_function=shutil.copy2 if copy else os.link)
+    elif copy:
+        shutil.copy2(src, dst)
+    else:
+        try:
+            os.link(src, dst)
+        except OSError:             # e.g. a different file system
+            shutil.copy2(src, dst)
+
+def entry_path(args, name, key):
+    return os.path.join(args.cache_path, name, key)
+
+def entry_outputs(path):
+    return [f for f in sorted(os.listdir(path)) if f not in ['stage.json', 'stdout.txt']]
+
+def is_cached(args, name, key):
+    return os.path.exists(os.path.join(entry_path(args, name, key), 'stage.json'))
+
+def run_stage(name, keys, args):
+    '''
+    Runs a stage in a temporary directory, with the outputs of the stages it depends on
+    linked in it, and moves its new files to the cache entry of its key
+    '''
+    entry = entry_path(args, name, keys[name])
+    work_path = entry + '.tmp'
+    if os.path.exists(work_path):
+        shutil.rmtree(work_path)
+    os.makedirs(work_path)
+    linked = set()
+    for dep in STAGES[name]['deps']:
+        dep_entry = entry_path(args, dep, keys[dep])
+        for f in entry_outputs(dep_entry):
+            link_or_copy(os.path.join(dep_entry, f), os.path.join(work_path, f))
+            linked.add(f)
+    command = [sys.executable, os.path.join(PREPROCESSING_PATH, STAGES[name]['script'])] + stage_params(name, args) + \
+        stage_runtime_args(name, args, work_path + '/')
+    start = time.time()
+    with open(os.path.join(work_path, 'stdout.txt'), 'w') as f:
+        result = subprocess.run(command, stdout=f, stderr=subprocess.STDOUT, cwd=WORKING_PATH)
+    if result.returncode != 0:
+        raise RuntimeError(f"Stage {name} failed, see {os.path.join(work_path, 'stdout.txt')}.")
+    for f in linked:
+        path = os.path.join(work_path, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    with open(os.path.join(work_path, 'stage.json'), 'w') as f:
+        json.dump({'stage': name, 'key': keys[name], 'command': command, 'seconds': time.time() - start,
+            'deps': {d: keys[d] for d in STAGES[name]['deps']}}, f, indent=4)
+    if os.path.exists(entry):
+        shutil.rmtree(entry)
+    os.rename(work_path, entry)
+    return time.time() - start
+
+def required_stages(requested):
+    '''
+    Returns the requested stages and the ones they depend on, in topological order
+    '''
+    required = set()
+    to_visit = list(requested)
+    while len(to_visit) > 0:
+        name = to_visit.pop()
+        if name not in required:
+            required.add(name)
+            to_visit += STAGES[name]['deps']
+    return [name for name in STAGES if name in required]
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    os.makedirs(args.output_path, exist_ok=True)
+    if args.cache_path is None:
+        args.cache_path = args.output_path + 'cache/'
+
+    requested = list(STAGES) if args.stages is None else args.stages
+    for name in requested + args.force:
+        if name not in STAGES:
+            raise ValueError(f"Unknown stage {name}, the stages are {list(STAGES)}.")
+    if 'era5' in requested and '--append' in shlex.split(args.era5_args):
+        raise RuntimeError("--append modifies the output store in place and cannot run in the pipeline.")
+
+    stages = required_stages(requested)
+    keys = stage_keys(args)
+    to_run = [name for name in stages if name in args.force or not is_cached(args, name, keys[name])]
+
+    write_log(f"\nPipeline: {', '.join(f'{name} ({keys[name]}, ' + ('run' if name in to_run else 'cached') + ')' for name in stages)}.", args)
+    if args.dry_run:
+        print('\n'.join(f"{name}: {keys[name]} " + ("run" if name in to_run else "cached") for name in stages))
+        sys.exit(0)
+
+    #-----------------------------------------------------
+    #------------- RUN THE STAGES (DAG ORDER) ------------
+    #-----------------------------------------------------
+
+    ## a stage starts as soon as the stages it depends on are done, so independent stages
+    ## (e.g. era5 and cells, or graph and targets) run at the same time
+    done = set(stages) - set(to_run)
+    waiting = list(to_run)
+    with ThreadPoolExecutor(max_workers=args.n_jobs) as pool:
+        running = dict()
+        while len(waiting) > 0 or len(running) > 0:
+            for name in [n for n in waiting if all(d in done for d in STAGES[n]['deps'])]:
+                waiting.remove(name)
+                running[pool.submit(run_stage, name, keys, args)] = name
+                write_log(f"\nStarted stage {name}.", args)
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                write_log(f"\nStage {name} done in {future.result():.1f} s.", args)
+                done.add(name)
+
+    #-----------------------------------------------------
+    #-------------------- RESTORE ------------------------
+    #-----------------------------------------------------
+
+    for name in stages:
+        entry = entry_path(args, name, keys[name])
+        for f in entry_outputs(entry):
+            link_or_copy(os.path.join(entry, f), args.output_path + f, copy=not args.link)
+
+    write_log(f"\nRestored the outputs of {', '.join(stages)} in {args.output_path}.", args)
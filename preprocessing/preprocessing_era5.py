@@ -5,6 +5,13 @@ import pickle
 import argparse
 import os
 import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import utils_stats
+import utils_store
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
@@ -20,17 +27,283 @@ parser.add_argument('--stds_file', type=str, default='stds.pkl')
 parser.add_argument('--mean_std_over_variable', action='store_true')
 parser.add_argument('--mean_std_over_variable_and_level', dest='mean_std_over_variable', action='store_false')
 parser.add_argument('--load_stats', action='store_true',help='load means and stds from files')
+parser.add_argument('--streaming', action='store_true', help='read, standardize and write the input in time chunks (the output is written as a .npy file)')
+parser.add_argument('--chunk_size', type=int, default=8760, help='number of time steps per chunk in streaming mode')
+parser.add_argument('--n_workers', type=int, default=1, help='number of processes used to compute the statistics')
+parser.add_argument('--store', action='store_true', help='write the output as a memory-mappable store directory (header.pkl + data.bin)')
+parser.add_argument('--codec', type=str, default=None, choices=['zlib', 'lzma', 'lz4'], help='write the output as a compressed, chunked store with the given codec')
+parser.add_argument('--chunk_hours', type=int, default=25, help='number of time steps per compressed chunk (matches the 25-hour input windows)')
+parser.add_argument('--layout', type=str, default='time_major', choices=['time_major', 'var_major'],
+    help='axes order of a raw store; var_major keeps the time series of each (variable, level) contiguous, so that subsets can be read alone')
+parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'float16', 'bfloat16'], help='precision of the values in the output store')
+parser.add_argument('--quantization_report_file', type=str, default='quantization_error.txt')
+parser.add_argument('--n_read_workers', type=int, default=1, help='number of processes reading the parameter files concurrently (1 = serial)')
+parser.add_argument('--no_standardize', action='store_true', help='write the raw values to the output store (standardized on the fly by the Dataset); '+
+    'the statistics are computed and written anyway')
+parser.add_argument('--append', action='store_true', help='append the new time steps of the input files to the existing output store, '+
+    'standardized with the statistics in stats_path')
+
+
+def write_log(s, args, mode='a'):
+    with open(args.output_path + args.log_file, mode) as f:
+        f.write(s)
+
+def input_file_paths(args, params):
+    return [f'{args.input_path}/{args.input_files_prefix}{p}.nc' for p in params]
+
+def open_input_files(args, params):
+    '''
+    Lazily opens the netCDF file of each parameter, without reading the data
+    Arguments:
+        args: the parsed arguments
+        params: list of the parameter names
+    Returns:
+        a list with the opened xarray datasets and the (time, lat, lon) dimensions
+    '''
+    files = [xr.open_dataset(path) for path in input_file_paths(args, params)]
+    time_dim = len(files[0].time)
+    lat_dim = len(files[0].latitude)
+    lon_dim = len(files[0].longitude)
+    return files, time_dim, lat_dim, lon_dim
+
+def get_levels(f, p, n_levels):
+    '''
+    Returns the values of the pressure levels of parameter p in the opened file f
+    '''
+    lev_dim = f[p].dims[1]
+    if lev_dim in f.coords:
+        return f[lev_dim].values[:n_levels].tolist()
+    return list(range(n_levels))
+
+def read_chunk(files, params, t_start, t_end, n_levels):
+    '''
+    Reads the time steps in [t_start, t_end) of all the parameters
+    Returns:
+        chunk: array of shape (t_end-t_start, n_params, n_levels, lat, lon), with
+            the latitude flipped so that the origin is in the bottom left corner
+    '''
+    chunk = np.stack([f[p].isel(time=slice(t_start, t_end)).values for f, p in zip(files, params)], axis=1)
+    chunk = np.flip(chunk[:,:,:n_levels], 3).astype(np.float32)
+    return chunk
+
+def read_param_into_shared(path, p, p_idx, shm_name, shape, t_start, t_end, n_levels):
+    '''
+    Reads the time steps in [t_start, t_end) of parameter p into its slot of the
+    shared (time, var, lev, lat, lon) array; used as process pool task, so only
+    the elapsed time goes back to the parent
+    '''
+    start = time.time()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        with xr.open_dataset(path) as f:
+            out[:t_end-t_start, p_idx] = f[p].isel(time=slice(t_start, t_end)).values[:, :n_levels]
+        del out
+    finally:
+        shm.close()
+    return p, time.time() - start
+
+class Parallel_reader(object):
+    '''
+    Reads the files of the parameters concurrently: each worker fills its parameter
+    slot of a preallocated shared memory array of shape (time, var, lev, lat, lon)
+    '''
+    def __init__(self, paths, params, shape, n_workers):
+        self.paths = paths
+        self.params = params
+        self.shape = tuple(shape)
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(self.shape)) * 4)
+        self.out = np.ndarray(self.shape, dtype=np.float32, buffer=self.shm.buf)
+        self.pool = ProcessPoolExecutor(max_workers=min(n_workers, len(params)))
+
+    def read(self, t_start, t_end, n_levels):
+        '''
+        Returns:
+            a view of the shared array with the time steps in [t_start, t_end), not flipped,
+            and a dict with the reading time of each parameter file
+        '''
+        futures = [self.pool.submit(read_param_into_shared, path, p, p_idx, self.shm.name, self.shape, t_start, t_end, n_levels)
+            for p_idx, (path, p) in enumerate(zip(self.paths, self.params))]
+        timings = dict(future.result() for future in as_completed(futures))
+        return self.out[:t_end-t_start], {p: timings[p] for p in self.params}
+
+    def close(self):
+        '''
+        Releases the pool and the shared memory; views of the shared array must be deleted before
+        '''
+        self.pool.shutdown()
+        del self.out
+        self.shm.close()
+        self.shm.unlink()
+
+def log_timings(timings, args):
+    write_log('\nRead ' + ', '.join(f'{p} in {timings[p]:.2f} s' for p in timings) + '.', args)
+
+def read_chunk_maybe_parallel(reader, files, params, t_start, t_end, n_levels, args):
+    '''
+    Same as read_chunk, using the parallel reader if there is one
+    '''
+    if reader is None:
+        return read_chunk(files, params, t_start, t_end, n_levels)
+    chunk, timings = reader.read(t_start, t_end, n_levels)
+    log_timings(timings, args)
+    return np.flip(chunk, 3).astype(np.float32)    # copy, so that the shared array can be refilled
+
+def read_chunk_moments(paths, params, t_start, t_end, n_levels):
+    '''
+    Reads the time steps in [t_start, t_end) and returns their partial moments;
+    used as process pool task, so it opens the files by itself
+    '''
+    files = [xr.open_dataset(path) for path in paths]
+    try:
+        return utils_stats.chunk_moments(read_chunk(files, params, t_start, t_end, n_levels))
+    finally:
+        for f in files:
+            f.close()
+
+def compute_stats_streaming(paths, params, time_dim, n_levels, chunk_size, mean_std_over_variable, n_workers=1):
+    '''
+    Computes means and stds with a single pass over the time chunks, merging
+    the partial moments of each chunk (chunks may be processed in parallel)
+    Returns:
+        means, stds: arrays of shape (n_params,) or (n_params, n_levels)
+    '''
+    tasks = [(paths, params, t_start, min(t_start + chunk_size, time_dim), n_levels) for t_start in range(0, time_dim, chunk_size)]
+    moments = utils_stats.accumulate_moments(read_chunk_moments, tasks, n_workers)
+    return utils_stats.moments_to_stats(moments, mean_std_over_variable)
+
+def close_writer(writer, args, params, levels):
+    writer.close()
+    if writer.error is not None:
+        writer.error.write_report(args.output_path + args.quantization_report_file, params, levels, args.precision)
+        write_log(f'\nQuantization error report written to {args.quantization_report_file}: maximum absolute error ' +
+            f'{writer.error.max.max():.6f}, mean absolute error {(writer.error.sum / writer.error.count).mean():.6f}.', args)
+
+def writes_store(args):
+    '''
+    Whether the output is a store directory rather than a .npy/.pkl file
+    '''
+    return args.store or args.codec is not None or args.precision != 'float32' or args.no_standardize or args.layout != 'time_major'
+
+def standardize_chunk(chunk, means, stds):
+    '''
+    Standardizes a (time, var, lev, lat, lon) chunk in place, with either
+    per-variable (ndim=1) or per-(variable, level) (ndim=2) statistics
+    '''
+    means = np.asarray(means, dtype=np.float32)
+    stds = np.asarray(stds, dtype=np.float32)
+    shape = (1, -1, 1, 1, 1) if means.ndim == 1 else (1,) + means.shape + (1, 1)
+    chunk -= means.reshape(shape)
+    chunk /= stds.reshape(shape)
+    return chunk
 
 
 if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    if args.no_standardize and args.precision != 'float32':   # e.g. the raw geopotential overflows float16 and is too coarse in bfloat16
+        raise RuntimeError("Reduced precision is only supported for standardized values, use --precision float32 with --no_standardize.")
+
     if not os.path.exists(args.output_path):
         os.makedirs(args.output_path)
 
     params = ['q', 't', 'u', 'v', 'z']
     n_params = len(params)
+
+    if args.append:
+        #-----------------------------------------------------
+        #------------ APPEND NEW TIME STEPS TO STORE ---------
+        #-----------------------------------------------------
+
+        store_path = args.output_path + os.path.splitext(args.output_file)[0]
+        write_log(f'\nAppending the new time steps of the input files to {store_path}.', args, 'w')
+        header = utils_store.read_header(store_path)
+        files, time_dim, lat_dim, lon_dim = open_input_files(args, params)
+        levels = get_levels(files[0], params[0], args.n_levels)
+        if header['params'] != params or header['levels'] != levels or tuple(header['shape'][3:]) != (lat_dim, lon_dim):
+            raise RuntimeError(f"The input files do not match the store: params {params}, levels {levels}, (lat, lon) {(lat_dim, lon_dim)}.")
+        if header.get('standardized', True):
+            means, stds = utils_stats.load_stats(args.stats_path, args.means_file, args.stds_file)    # frozen statistics
+
+        ## only the time steps after the last one in the store are new
+        times = files[0].time.values
+        if 'time_end' not in header:
+            raise RuntimeError(f"The store {store_path} has no time_end in its header: it predates append support, rebuild it.")
+        time_end = np.datetime64(header['time_end'])
+        t_first = int(np.searchsorted(times, time_end, side='right'))
+        if t_first < time_dim and t_first > 0 and times[t_first] - times[t_first-1] != times[1] - times[0]:
+            raise RuntimeError(f"The new time steps do not follow the last one in the store ({header['time_end']}).")
+        if t_first == 0 and times[0] - time_end != times[1] - times[0]:
+            raise RuntimeError(f"The input files start at {times[0]}, which does not follow the last time step in the store ({header['time_end']}).")
+        n_new = time_dim - t_first
+        write_log(f"\nThe store has {header['shape'][0]} time steps, {n_new} new ones will be appended.", args)
+        if n_new == 0:
+            for f in files:
+                f.close()
+            write_log("\nThe store is up to date, nothing to append.\nPreprocessing finished.", args)
+            sys.exit(0)
+
+        writer = utils_store.open_store_appender(store_path, n_new, time_end=times[-1])
+        reader = None
+        if args.n_read_workers > 1:
+            reader = Parallel_reader(input_file_paths(args, params), params, (min(args.chunk_size, n_new), n_params, args.n_levels, lat_dim, lon_dim), args.n_read_workers)
+        for t_start in range(t_first, time_dim, args.chunk_size):
+            t_end = min(t_start + args.chunk_size, time_dim)
+            chunk = read_chunk_maybe_parallel(reader, files, params, t_start, t_end, args.n_levels, args)
+            writer.append(standardize_chunk(chunk, means, stds) if header.get('standardized', True) else chunk)
+            write_log(f'\nTime steps {t_start} - {t_end} done.', args)
+        if reader is not None:
+            reader.close()
+        close_writer(writer, args, params, levels)
+        for f in files:
+            f.close()
+
+        write_log(f"\nStore extended to {header['shape'][0] + n_new} time steps.\nPreprocessing finished.", args)
+        sys.exit(0)
+
+    if args.streaming:
+        #-----------------------------------------------------
+        #---------- STREAMING (CHUNKED) PREPROCESSING --------
+        #-----------------------------------------------------
+
+        write_log(f'\nStarting to create the input dataset from files in chunks of {args.chunk_size} time steps.', args, 'w')
+        files, time_dim, lat_dim, lon_dim = open_input_files(args, params)
+
+        if args.load_stats:
+            means, stds = utils_stats.load_stats(args.stats_path, args.means_file, args.stds_file)
+        else:
+            write_log(f'\nComputing the statistics.', args)
+            means, stds = compute_stats_streaming(input_file_paths(args, params), params, time_dim, args.n_levels, args.chunk_size,
+                args.mean_std_over_variable, args.n_workers)
+            utils_stats.write_stats(means, stds, args.output_path)
+
+        shape = (time_dim, n_params, args.n_levels, lat_dim, lon_dim)
+        levels = get_levels(files[0], params[0], args.n_levels)
+        if writes_store(args):
+            output_file = os.path.splitext(args.output_file)[0]
+            writer = utils_store.open_store_writer(args.output_path + output_file, shape, params, levels, precision=args.precision, standardized=not args.no_standardize,
+                time_range=(files[0].time.values[0], files[0].time.values[-1]), codec=args.codec, chunk_hours=args.chunk_hours, layout=args.layout)
+        else:
+            output_file = os.path.splitext(args.output_file)[0] + '.npy'
+            writer = utils_store.Npy_writer(args.output_path + output_file, shape)
+        write_log(f'\nStandardizing and writing the output file {output_file}.', args)
+        reader = None
+        if args.n_read_workers > 1:
+            reader = Parallel_reader(input_file_paths(args, params), params, (min(args.chunk_size, time_dim),) + shape[1:], args.n_read_workers)
+        for t_start in range(0, time_dim, args.chunk_size):
+            t_end = min(t_start + args.chunk_size, time_dim)
+            chunk = read_chunk_maybe_parallel(reader, files, params, t_start, t_end, args.n_levels, args)
+            writer.append(chunk if args.no_standardize else standardize_chunk(chunk, means, stds))
+            write_log(f'\nTime steps {t_start} - {t_end} done.', args)
+        if reader is not None:
+            reader.close()
+        close_writer(writer, args, params, levels)
+        for f in files:
+            f.close()
+
+        write_log(f'\nOutput file written.\nPreprocessing finished.', args)
+        sys.exit(0)
  
     #-----------------------------------------------------
     #-------------- INPUT TENSOR FROM FILES --------------
@@ -39,17 +312,34 @@ if __name__ == '__main__':
     with open(args.output_path + args.log_file, 'w') as f:
         f.write(f'\nStarting to create the input dataset from files.')
 
-    for p_idx, p in enumerate(params):
+    reader = None
+    if args.n_read_workers > 1:
+        files, time_dim, lat_dim, lon_dim = open_input_files(args, params)
+        levels = get_levels(files[0], params[0], args.n_levels)
+        time_range = (files[0].time.values[0], files[0].time.values[-1])
+        for f in files:
+            f.close()
         with open(args.output_path + args.log_file, 'a') as f:
-            f.write(f'\nPreprocessing {args.input_files_prefix}{p}.nc ...')
-        with xr.open_dataset(f'{args.input_path}/{args.input_files_prefix}{p}.nc') as f:
-            data = f[p].values
-            if p_idx == 0: # first parameter being processed -> get dimensions and initialize the input dataset
-                lat_dim = len(f.latitude)
-                lon_dim = len(f.longitude)
-                time_dim = len(f.time)
-                input_ds = np.zeros((time_dim, n_params, args.n_levels, lat_dim, lon_dim), dtype=np.float32) # variables, levels, time, lat, lon
-        input_ds[:, p_idx,:,:,:] = data
+            f.write(f'\nReading the {n_params} parameter files with {min(args.n_read_workers, n_params)} processes ...')
+        reader = Parallel_reader(input_file_paths(args, params), params, (time_dim, n_params, args.n_levels, lat_dim, lon_dim), args.n_read_workers)
+        input_ds, timings = reader.read(0, time_dim, args.n_levels)
+        log_timings(timings, args)
+    else:
+        for p_idx, p in enumerate(params):
+            with open(args.output_path + args.log_file, 'a') as f:
+                f.write(f'\nPreprocessing {args.input_files_prefix}{p}.nc ...')
+            start = time.time()
+            with xr.open_dataset(f'{args.input_path}/{args.input_files_prefix}{p}.nc') as f:
+                data = f[p].values
+                if p_idx == 0: # first parameter being processed -> get dimensions and initialize the input dataset
+                    lat_dim = len(f.latitude)
+                    lon_dim = len(f.longitude)
+                    time_dim = len(f.time)
+                    levels = get_levels(f, p, args.n_levels)
+                    time_range = (f.time.values[0], f.time.values[-1])
+                    input_ds = np.zeros((time_dim, n_params, args.n_levels, lat_dim, lon_dim), dtype=np.float32) # variables, levels, time, lat, lon
+            input_ds[:, p_idx,:,:,:] = data[:, :args.n_levels]
+            log_timings({p: time.time() - start}, args)
 
     #-----------------------------------------------------
     #-------------- POST-PROCESSING OF INPUT--------------
@@ -58,55 +348,31 @@ if __name__ == '__main__':
     # flip the dataset
     input_ds = np.flip(input_ds, 3) # the origin in the input files is in the top left corner, while we use the bottom left corner
 
-    # standardizing the dataset
-    with open(args.output_path + args.log_file, 'a') as f:
-        f.write(f'\nStandardizing the dataset.')
-    
-    input_ds_standard = np.zeros((input_ds.shape), dtype=np.float32)
-    
     if args.load_stats:
-        with open(args.stats_path+args.means_file, 'rb') as f:
-            means = pickle.load(f)
-        with open(args.stats_path+args.stds_file, 'rb') as f:
-            stds = pickle.load(f)
-
-    if not args.mean_std_over_variable:
-        if not args.load_stats:
-            means = np.zeros((5))
-            stds = np.zeros((5))
-            for var in range(5):
-                m = np.mean(input_ds[:,var,:,:,:])
-                s = np.std(input_ds[:,var,:,:,:])
-                input_ds_standard[:,var,:,:,:] = (input_ds[:,var,:,:,:]-m)/s
-                means[var] = m
-                stds[var] = s
-        else:
-            for var in range(5):
-                input_ds_standard[:,var,:,:,:] = (input_ds[:,var,:,:,:]-means[var])/stds[var]    
+        means, stds = utils_stats.load_stats(args.stats_path, args.means_file, args.stds_file)
+    else:
+        means, stds = utils_stats.stats_from_array(input_ds, args.mean_std_over_variable, args.chunk_size)
+        utils_stats.write_stats(means, stds, args.output_path)
+
+    # standardizing the dataset
+    if args.no_standardize:
+        input_ds_standard = np.ascontiguousarray(input_ds)   # raw values, standardized on the fly by the Dataset
     else:
-        if not args.load_stats:
-            means = np.zeros((5,5))
-            stds = np.zeros((5,5))
+        with open(args.output_path + args.log_file, 'a') as f:
+            f.write(f'\nStandardizing the dataset.')
+        input_ds_standard = np.zeros((input_ds.shape), dtype=np.float32)
+        if not args.mean_std_over_variable:
             for var in range(5):
-                for lev in range(5):
-                    m = np.mean(input_ds[:,var,lev,:,:])
-                    s = np.std(input_ds[:,var,lev,:,:])
-                    input_ds_standard[:,var,lev,:,:] = (input_ds[:,var,lev,:,:]-m)/s
-                    means[var, lev] = m
-                    stds[var, lev] = s
+                input_ds_standard[:,var,:,:,:] = (input_ds[:,var,:,:,:]-means[var])/stds[var]    
         else:
             for var in range(5):
                 for lev in range(5):
                     input_ds_standard[:,var,lev,:,:] = (input_ds[:,var,lev,:,:]-means[var, lev])/stds[var, lev]
 
-    if not args.load_stats:
-        with open(args.output_path + "means.pkl", 'wb') as f:
-            pickle.dump(means, f)
-        with open(args.output_path + "stds.pkl", 'wb') as f:
-            pickle.dump(stds, f)
+    if reader is not None:
+        del input_ds    # the shared array is released once the standardized copy exists
+        reader.close()
     
-    input_ds_standard = torch.tensor(input_ds_standard)
-
     # write the input datasets to files
     with open(args.output_path + args.log_file, 'a') as f:
         f.write(f'\nStarting to write the output file.')
@@ -114,8 +380,15 @@ if __name__ == '__main__':
     #with open(args.output_path + args.output_file, 'wb') as f:
     #    pickle.dump(input_ds, f)
     
-    with open(args.output_path + args.output_file, 'wb') as f:
-        pickle.dump(input_ds_standard, f)
+    if writes_store(args):
+        writer = utils_store.open_store_writer(args.output_path + os.path.splitext(args.output_file)[0], input_ds_standard.shape, params, levels,
+            precision=args.precision, standardized=not args.no_standardize, time_range=time_range, codec=args.codec, chunk_hours=args.chunk_hours, layout=args.layout)
+        writer.append(input_ds_standard)
+        close_writer(writer, args, params, levels)
+    else:
+        input_ds_standard = torch.tensor(input_ds_standard)
+        with open(args.output_path + args.output_file, 'wb') as f:
+            pickle.dump(input_ds_standard, f)
     
     with open(args.output_path + args.log_file, 'a') as f:
         f.write(f'\nOutput file written.\nPreprocessing finished.')
@@ -9,6 +9,11 @@ import os
 
 from torch_geometric.data import Data
 
+import utils_graph
+import utils_gripho
+import utils_targets
+import utils_time
+
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
 #-- paths
@@ -26,20 +31,28 @@ parser.add_argument('--lat_max', type=float, default=47.50)
 parser.add_argument('--interval', type=float, default=0.25)
 parser.add_argument('--time_dim', type=float, default=140256)
 parser.add_argument('--offset_9_cells', type=float, default=0.25)
+parser.add_argument('--split_file', type=str, default=None, help='json file with the train/test split description (see utils_time.py), '+
+    'default: test from 2015-12-01, 24 hours of warm-up')
+parser.add_argument('--threshold', type=float, default=0.1, help='precipitation threshold (mm) of the classification target')
+parser.add_argument('--dense_reg_target', action='store_true', help='write the regression target as a dense tensor instead of the sparse format')
+parser.add_argument('--time_chunk', type=int, default=8760, help='number of time steps per chunk when scanning the precipitation')
+parser.add_argument('--n_read_workers', type=int, default=1, help='number of processes reading the precipitation time chunks in parallel')
 
 #-- other
 parser.add_argument('--suffix', type=str, default='')
+parser.add_argument('--stage', type=str, default='all', choices=['all', 'cells', 'graph', 'targets', 'indexes'],
+    help='run a single stage, reading the outputs of the previous ones from output_path (graph and targets need cells, indexes needs cells and targets)')
 
-def cut_window(lon_min, lon_max, lat_min, lat_max, lon, lat, z, pr, time_dim):
+def cut_window(lon_min, lon_max, lat_min, lat_max, lon, lat):
     '''
-    Derives a new version of the longitude, latitude and precipitation
-    tensors, by only retaining the values inside the specified lon-lat rectangle
+    Finds the nodes inside the specified lon-lat rectangle; only the coordinates
+    are needed, so that the precipitation and the topography can be read for the
+    selected nodes only
     Arguments:
         lon_min, lon_max, lat_min, lat_max: integers
-        lon, lat, z, pr: tensors
-        time_dim: an integet
+        lon, lat: tensors
     Returns:
-        The new tensors with the selected values
+        The selected lon and lat and the indexes of the selected nodes
 
     '''
     bool_lon = np.logical_and(lon >= lon_min, lon <= lon_max)
@@ -47,63 +60,12 @@ def cut_window(lon_min, lon_max, lat_min, lat_max, lon, lat, z, pr, time_dim):
     bool_both = np.logical_and(bool_lon, bool_lat)
     lon_sel = lon[bool_both]
     lat_sel = lat[bool_both]
-    z_sel = z[bool_both]
-    pr_sel = np.array(pr[:,bool_both])
-    return lon_sel, lat_sel, z_sel, pr_sel
-
-def select_nodes(lon_centre, lat_centre, lon, lat, pr, cell_idx, cell_idx_array, mask_1_cell_subgraphs, mask_9_cells_subgraphs, offset=0.25, offset_9=0.25):
-    '''
-    Creates the single cell data structure, by only retaining the values
-    correspondent to the nodes that fall inside the considered cell, which
-    is identified by its centre lon and lat values and a specified offset
-    Arguments:
-        lon_centre, lat_centre = integers
-        lon, lat, pr = tensors
-        cell_idx:
-        cell_idx_array:
-        offset, offset_9: integers
-        mask_1_cell_subgraphs, mask_9_cells_subgraphs: lists
-    Returns:
-
-    '''
-    bool_lon = np.logical_and(lon >= lon_centre, lon <= lon_centre+offset)
-    bool_lat = np.logical_and(lat >= lat_centre, lat <= lat_centre+offset)
-    bool_both = np.logical_and(bool_lon, bool_lat)
-    bool_lon_9 = np.logical_and(lon >= lon_centre - offset_9, lon <= lon_centre + offset + offset_9)
-    bool_lat_9 = np.logical_and(lat >= lat_centre - offset_9, lat <= lat_centre + offset + offset_9)
-    bool_both_9 = np.logical_and(bool_lon_9, bool_lat_9)
-    bool_both_9 = np.logical_or(bool_both, bool_both_9)
-    mask_1_cell_subgraphs[cell_idx, :] = bool_both
-    mask_9_cells_subgraphs[cell_idx, :] = bool_both_9
-    cell_idx_array[bool_both] = cell_idx
-    flag_valid_example = False
-    for i in np.argwhere(bool_both):
-        if np.all(np.isnan(pr[:,i])):
-            cell_idx_array[i] *= -1
-        else:
-            flag_valid_example = True
-    return cell_idx_array, flag_valid_example, mask_1_cell_subgraphs, mask_9_cells_subgraphs
+    return lon_sel, lat_sel, np.flatnonzero(bool_both)
 
 def write_log(s, args, mode='a'):
     with open(args.output_path + args.log_file, mode) as f:
         f.write(s)
 
-def subdivide_train_test_time_indexes(idx_time_years, first_test_year=2016, end_year=2016):
-    idx_time_train = []
-    idx_time_test = []
-    idx_first_test_year = first_test_year-2000-1
-    for idx_time_y in idx_time_years[:idx_first_test_year-1]:
-        idx_time_train += idx_time_y
-    idx_time_train += idx_time_years[idx_first_test_year-1][:-31*24]
-    idx_time_test = idx_time_years[idx_first_test_year-1][-31*24:]
-    for y in range(first_test_year, end_year + 1): 
-        idx_time_test += idx_time_years[y-2000-1]
-    idx_time_train.sort(); idx_time_test.sort()
-    for i in range(24):
-        idx_time_train.remove(i)
-    return idx_time_train, idx_time_test
-
-
 if __name__ == '__main__':
 
     args = parser.parse_args()
@@ -131,283 +93,295 @@ if __name__ == '__main__':
     #------------------- TIME INDEXES --------------------
     #-----------------------------------------------------
 
-    with open("idx_time_2001-2016.pkl", 'rb') as f:
-        idx_time_years = pickle.load(f)
+    ## the splits are built from the datetime coordinate of the GRIPHO file
+    with xr.open_dataset(args.target_path_file) as gripho:
+        time_index = utils_time.TimeIndex(gripho.time.values)
 
-    idx_time_train, idx_time_test = subdivide_train_test_time_indexes(idx_time_years)
-    time_train_dim = len(range(min(idx_time_train), max(idx_time_train)+1))
+    split = time_index.split(utils_time.load_split_spec(args.split_file))
+    idx_time_train, idx_time_test = split['train'], split['test']     # int arrays
+    time_train_dim = idx_time_train.max() - idx_time_train.min() + 1
 
-    with open(args.output_path + "idx_time_test.pkl", 'wb') as f:
-        pickle.dump(idx_time_test, f)
+    if args.stage in ['all', 'cells']:
+        with open(args.output_path + "idx_time_test.pkl", 'wb') as f:
+            pickle.dump(idx_time_test, f)
 
-    with open(args.output_path + "idx_time_train.pkl", 'wb') as f:
-        pickle.dump(idx_time_train, f)
+        with open(args.output_path + "idx_time_train.pkl", 'wb') as f:
+            pickle.dump(idx_time_train, f)
 
-    write_log(f"\nTrain idxs from {min(idx_time_train)} to {max(idx_time_train)}. Test idxs from {min(idx_time_test)} to {max(idx_time_test)}.", args, 'w')
-    
-    #-----------------------------------------------------
-    #----------- CUT LON, LAT, PR, Z TO WINDOW -----------
-    #-----------------------------------------------------
+    write_log(f"\nTrain idxs from {idx_time_train.min()} to {idx_time_train.max()}. Test idxs from {idx_time_test.min()} to {idx_time_test.max()}.", args, 'w')
 
-    gripho = xr.open_dataset(args.target_path_file)
-    topo = xr.open_dataset(args.topo_path_file)
+    ## the stages to run: pipeline.py runs them one at a time, so that only the stages whose inputs
+    ## changed are rebuilt; when a stage runs alone, the outputs of the previous ones are read from output_path
+    stages = ['cells', 'targets', 'graph', 'indexes'] if args.stage == 'all' else [args.stage]
+    start = time.time()
 
-    lon = gripho.lon.to_numpy()
-    lat = gripho.lat.to_numpy()
-    pr = gripho.pr.to_numpy()
-    z = topo.z.to_numpy()
+    if 'cells' in stages:
 
-    write_log("\nCutting the window...", args)
+        #-----------------------------------------------------
+        #----------- CUT LON, LAT, PR, Z TO WINDOW -----------
+        #-----------------------------------------------------
 
-    # cut gripho and topo to the desired window
-    lon_sel, lat_sel, z_sel, pr_sel = cut_window(args.lon_min, args.lon_max, args.lat_min, args.lat_max, lon, lat, z, pr, args.time_dim)
-    n_nodes = pr_sel.shape[1]
+        gripho = xr.open_dataset(args.target_path_file)
+        topo = xr.open_dataset(args.topo_path_file)
 
-    write_log(f"\nDone! Window is [{lon_sel.min()}, {lon_sel.max()}] x [{lat_sel.min()}, {lat_sel.max()}] with {n_nodes} nodes.", args)
+        lon = gripho.lon.to_numpy()
+        lat = gripho.lat.to_numpy()
 
-    #-----------------------------------------------------
-    #--------------- DERIVE CELLS MAPPINGS ---------------
-    #-----------------------------------------------------
+        write_log("\nCutting the window...", args)
 
-    cell_idx_array = np.zeros(n_nodes) # will contain the mapping of each node to the corresponding low_res cell idx
-    mask_1_cell_subgraphs = np.zeros((space_low_res_dim, n_nodes)).astype(bool)     # maps each low_res_cell idx to the corresponding 9 cell mask
-    mask_9_cells_subgraphs = np.zeros((space_low_res_dim,n_nodes)).astype(bool)     # maps each low_res_cell idx to the corresponding 9 cells mask
-    graph_cells_space = []
+        # cut gripho and topo to the desired window
+        lon_sel, lat_sel, node_idx = cut_window(args.lon_min, args.lon_max, args.lat_min, args.lat_max, lon, lat)
+        z_sel = topo.z[node_idx].to_numpy()                                     # lazy, only the selected nodes are read
+        pr_sel = utils_gripho.Node_reader(args.target_path_file, 'pr', node_idx, n_workers=args.n_read_workers)   # (time, num_nodes), read in time chunks
+        n_nodes = pr_sel.shape[1]
 
-    valid_examples_space = [ii * lon_low_res_dim + jj for ii in range(1,lat_low_res_dim-1) for jj in range(1,lon_low_res_dim-1)]
-    
-    ## start the preprocessing
-    write_log(f"\nStarting the preprocessing.", args)
-    start = time.time()
+        write_log(f"\nDone! Window is [{lon_sel.min()}, {lon_sel.max()}] x [{lat_sel.min()}, {lat_sel.max()}] with {n_nodes} nodes.", args)
 
-    for i, lat_low_res in enumerate(lat_low_res_array):
-        for j, lon_low_res in enumerate(lon_low_res_array):
-            cell_idx = i * lon_low_res_dim + j
-            cell_idx_array, flag_valid_example, mask_1_cell_subgraphs, mask_9_cells_subgraphs = select_nodes(lon_low_res, lat_low_res, lon_sel, lat_sel, pr_sel, cell_idx,
-                    cell_idx_array, mask_1_cell_subgraphs, mask_9_cells_subgraphs, offset=args.interval, offset_9=args.offset_9_cells)         
-            if cell_idx in valid_examples_space:
-                if flag_valid_example:
-                    idx_list = np.array([ii * lon_low_res_dim + jj for ii in range(i-1,i+2) for jj in range(j-1,j+2)])
-                    _ = [graph_cells_space.append(abs(d)) for d in idx_list]
-                else:
-                    valid_examples_space.remove(cell_idx)
+        #-----------------------------------------------------
+        #--------------- DERIVE CELLS MAPPINGS ---------------
+        #-----------------------------------------------------
+
+        valid_examples_space = [ii * lon_low_res_dim + jj for ii in range(1,lat_low_res_dim-1) for jj in range(1,lon_low_res_dim-1)]
+    
+        ## start the preprocessing
+        write_log(f"\nStarting the preprocessing.", args)
+        start_cells = time.time()
+
+        ## assign each node to the cells that contain it (borders included), with the same bounds as the cells
+        ## [lon, lon + interval] x [lat, lat + interval] and their 9 cells neighbourhoods
+        cells_1, nodes_1 = utils_graph.cell_memberships(lon_sel, lat_sel, lon_low_res_array, lon_low_res_array + args.interval,
+            lat_low_res_array, lat_low_res_array + args.interval)
+        cells_9, nodes_9 = utils_graph.cell_memberships(lon_sel, lat_sel, lon_low_res_array - args.offset_9_cells, lon_low_res_array + args.interval + args.offset_9_cells,
+            lat_low_res_array - args.offset_9_cells, lat_low_res_array + args.interval + args.offset_9_cells)
+        keys_9 = np.union1d(cells_9 * n_nodes + nodes_9, cells_1 * n_nodes + nodes_1)     # the 9 cells mask includes the 1 cell mask
+        cells_9, nodes_9 = keys_9 // n_nodes, keys_9 % n_nodes
+        mask_1_cell_subgraphs = utils_graph.csr_from_pairs(cells_1, nodes_1, space_low_res_dim, n_nodes)     # maps each low_res_cell idx to its nodes
+        mask_9_cells_subgraphs = utils_graph.csr_from_pairs(cells_9, nodes_9, space_low_res_dim, n_nodes)    # maps each low_res_cell idx to the nodes of the 9 cells
+
+        ## mapping of each node to the corresponding low_res cell idx (the largest one for the nodes on a border),
+        ## with a negative sign for the nodes that have no valid precipitation value
+        ever_observed, n_valid_hours = utils_graph.node_validity(pr_sel, args.time_chunk)
+        all_nan = ~ever_observed
+        write_log(f"\n{all_nan.sum()} nodes have no valid precipitation value; the others have {np.median(n_valid_hours[ever_observed]):.0f} valid hours (median).", args)
+        max_cell = np.full(n_nodes, -1)
+        np.maximum.at(max_cell, nodes_1, cells_1)
+        cell_idx_array = np.where(max_cell >= 0, max_cell, 0).astype(float)
+        cell_idx_array[np.logical_and(all_nan, max_cell >= 0)] *= -1
+
+        ## a cell is a valid example if at least one of its nodes has a valid precipitation value
+        flag_valid_example = np.bincount(cells_1, weights=~all_nan[nodes_1], minlength=space_low_res_dim) > 0
+        valid_examples_space = [s for s in valid_examples_space if flag_valid_example[s]]
+        graph_cells_space = set()
+        for s in valid_examples_space:
+            i, j = s // lon_low_res_dim, s % lon_low_res_dim
+            graph_cells_space.update(ii * lon_low_res_dim + jj for ii in range(i-1,i+2) for jj in range(j-1,j+2))
     
-    graph_cells_space = list(set(graph_cells_space))
-    graph_cells_space.sort()
-    valid_examples_space.sort()
-
-    end = time.time()
-    write_log(f'\nLoop took {end - start} s', args)
-
-    ## keep only the graph cells space idxs
-    mask_graph_cells_space = np.in1d(abs(cell_idx_array), graph_cells_space)
-    mask_1_cell_subgraphs = mask_1_cell_subgraphs[:,mask_graph_cells_space]
-    mask_1_cell_subgraphs = torch.tensor(mask_1_cell_subgraphs)
-    mask_9_cells_subgraphs = mask_9_cells_subgraphs[:,mask_graph_cells_space]
-    mask_9_cells_subgraphs = torch.tensor(mask_9_cells_subgraphs)
+        graph_cells_space = list(graph_cells_space)
+        graph_cells_space.sort()
+        valid_examples_space.sort()
+
+        end = time.time()
+        write_log(f'\nCell assignment took {end - start_cells} s', args)
+
+        ## keep only the graph cells space idxs
+        mask_graph_cells_space = np.in1d(abs(cell_idx_array), graph_cells_space)
+        mask_1_cell_subgraphs = utils_graph.csr_select_columns(mask_1_cell_subgraphs, mask_graph_cells_space)
+        mask_9_cells_subgraphs = utils_graph.csr_select_columns(mask_9_cells_subgraphs, mask_graph_cells_space)
     
-    idx_test = [t * space_low_res_dim + s for s in range(space_low_res_dim) for t in idx_time_test if s in valid_examples_space]
-    idx_test = np.array(idx_test)
+        ## k = t * space_low_res_dim + s, ordered by s and then by t
+        idx_test = (idx_time_test[None,:] * space_low_res_dim + np.array(valid_examples_space, dtype=int)[:,None]).ravel()
    
-    idx_train_ae = [t * space_low_res_dim + s for s in range(space_low_res_dim) for t in idx_time_train if s in valid_examples_space]
-    idx_train_ae = np.array(idx_train_ae)
+        idx_train_ae = (idx_time_train[None,:] * space_low_res_dim + np.array(valid_examples_space, dtype=int)[:,None]).ravel()
 
-    lon_sel = lon_sel[mask_graph_cells_space]
-    lat_sel = lat_sel[mask_graph_cells_space]
-    z_sel = z_sel[mask_graph_cells_space]
-    pr_sel = pr_sel[:, mask_graph_cells_space] # (time, num_nodes)
-    cell_idx_array = cell_idx_array[mask_graph_cells_space]
+        lon_sel = lon_sel[mask_graph_cells_space]
+        lat_sel = lat_sel[mask_graph_cells_space]
+        z_sel = z_sel[mask_graph_cells_space]
+        pr_sel = pr_sel.select_nodes(mask_graph_cells_space) # (time, num_nodes)
+        node_idx = node_idx[mask_graph_cells_space]
+        cell_idx_array = cell_idx_array[mask_graph_cells_space]
 
-    n_nodes = cell_idx_array.shape[0]
+        n_nodes = cell_idx_array.shape[0]
     
-    ## write some files
-    with open(args.output_path + 'mask_1_cell_subgraphs' + args.suffix + '.pkl', 'wb') as f:
-        pickle.dump(mask_1_cell_subgraphs, f)
+        ## write some files
+        with open(args.output_path + 'mask_1_cell_subgraphs' + args.suffix + '.pkl', 'wb') as f:
+            pickle.dump(mask_1_cell_subgraphs, f)
     
-    with open(args.output_path + 'mask_9_cells_subgraphs' + args.suffix + '.pkl', 'wb') as f:
-        pickle.dump(mask_9_cells_subgraphs, f)
+        with open(args.output_path + 'mask_9_cells_subgraphs' + args.suffix + '.pkl', 'wb') as f:
+            pickle.dump(mask_9_cells_subgraphs, f)
    
-    with open(args.output_path + 'idx_test.pkl', 'wb') as f:
-        pickle.dump(idx_test, f)
+        with open(args.output_path + 'idx_test.pkl', 'wb') as f:
+            pickle.dump(idx_test, f)
     
-    with open(args.output_path + 'idx_train_ae.pkl', 'wb') as f:
-        pickle.dump(idx_train_ae, f)
+        with open(args.output_path + 'idx_train_ae.pkl', 'wb') as f:
+            pickle.dump(idx_train_ae, f)
 
-    with open(args.output_path + 'valid_examples_space.pkl', 'wb') as f:   # low res cells indexes valid as examples for the training
-        pickle.dump(valid_examples_space, f)
+        with open(args.output_path + 'valid_examples_space.pkl', 'wb') as f:   # low res cells indexes valid as examples for the training
+            pickle.dump(valid_examples_space, f)
 
-    with open(args.output_path + 'graph_cells_space.pkl', 'wb') as f:      # all low res cells that are used (examples + surroundings)
-        pickle.dump(graph_cells_space, f)
+        with open(args.output_path + 'graph_cells_space.pkl', 'wb') as f:      # all low res cells that are used (examples + surroundings)
+            pickle.dump(graph_cells_space, f)
         
-    with open(args.output_path + 'cell_idx_array.pkl', 'wb') as f:         # array that assigns to each high res node the corresponding low res cell index
-        pickle.dump(cell_idx_array, f)
-
-    #-------------------------------------------------
-    #----- CLASSIFICATION AND REGRESSION TARGETS -----
-    #-------------------------------------------------
-
-    threshold = 0.1 # mm
-    pr_sel = pr_sel.swapaxes(0,1) # (num_nodes, time)
-    pr_sel_train = pr_sel[:,:max(idx_time_train)+1]
-    pr_sel_train_cl = np.array([np.where(pr >= threshold, 1, 0) for pr in pr_sel_train], dtype=np.float32)
-    pr_sel_train_cl[np.isnan(pr_sel_train)] = np.nan
-    pr_sel_train_reg = np.array([np.where(pr >= threshold, np.log1p(pr), np.nan) for pr in pr_sel_train], dtype=np.float32)
-    pr_sel_test = pr_sel[:,min(idx_time_test):max(idx_time_test)+1]
-
-    #-------------------------------------------------
-    #----------- STANDARDISE LON LAT AND Z -----------
-    #-------------------------------------------------
-    
-    use_precomputed_means_stds = True
-
-    if use_precomputed_means_stds:
-        write_log(f"\nUsing statistics over italy for lat, lon and z.", args)
-        with open("lat_lon_z_best.pkl", 'rb') as f:
-            lat_lon_z_best = pickle.load(f)
-        z_sel_s = (z_sel - np.mean(lat_lon_z_best[:,2])) / np.std(lat_lon_z_best[:,2])
-        lon_sel_s = (lon_sel - np.mean(lat_lon_z_best[:,1])) / np.std(lat_lon_z_best[:,1])
-        lat_sel_s = (lat_sel - np.mean(lat_lon_z_best[:,0])) / np.std(lat_lon_z_best[:,0])
+        with open(args.output_path + 'cell_idx_array.pkl', 'wb') as f:         # array that assigns to each high res node the corresponding low res cell index
+            pickle.dump(cell_idx_array, f)
+
+        with open(args.output_path + 'graph_nodes.pkl', 'wb') as f:            # the graph nodes (GRIPHO indexes and coordinates), read by the other stages
+            pickle.dump({'node_idx': node_idx, 'lon': lon_sel, 'lat': lat_sel, 'z': z_sel}, f)
+
     else:
-        write_log(f"\nUsing local statistics for lat, lon and z.", args)
-        z_sel_s = (z_sel - z_sel.mean()) / z_sel.std()
-        lon_sel_s = (lon_sel - lon_sel.mean()) / lon_sel.std()
-        lat_sel_s = (lat_sel - lat_sel.mean()) / lat_sel.std()
-    
-    lon_lat_z_s = np.empty((z_sel_s.shape[0], 3))
+        with open(args.output_path + 'graph_nodes.pkl', 'rb') as f:
+            graph_nodes = pickle.load(f)
+        with open(args.output_path + 'cell_idx_array.pkl', 'rb') as f:
+            cell_idx_array = pickle.load(f)
+        with open(args.output_path + 'valid_examples_space.pkl', 'rb') as f:
+            valid_examples_space = pickle.load(f)
+        lon_sel, lat_sel, z_sel = graph_nodes['lon'], graph_nodes['lat'], graph_nodes['z']
+        pr_sel = utils_gripho.Node_reader(args.target_path_file, 'pr', graph_nodes['node_idx'], n_workers=args.n_read_workers)  # (time, num_nodes)
+        n_nodes = cell_idx_array.shape[0]
+
+    if 'targets' in stages:
+
+        #-------------------------------------------------
+        #----- CLASSIFICATION AND REGRESSION TARGETS -----
+        #-------------------------------------------------
+
+        start_targets = time.time()
+        pr_sel_train_cl, pr_sel_train_reg, mask_train_cl, mask_train_reg = utils_targets.build_train_targets(pr_sel, idx_time_train.max()+1,
+            args.threshold, args.time_chunk, sparse_reg=not args.dense_reg_target)     # (time, num_nodes)
+        write_log(f"\nTargets built in {time.time() - start_targets} s.", args)
+
+        ## write some files
+        with open(args.output_path + 'target_train_cl.pkl', 'wb') as f:          # time-major (see utils_targets.py)
+            pickle.dump(utils_targets.dense_target(pr_sel_train_cl), f)    
+     
+        with open(args.output_path + 'target_train_reg.pkl', 'wb') as f:         # sparse by time (see utils_targets.py) unless --dense_reg_target
+            pickle.dump(pr_sel_train_reg if isinstance(pr_sel_train_reg, dict) else utils_targets.dense_target(pr_sel_train_reg), f)    
 
-    lon_lat_z_s[:,0] = lon_sel_s
-    lon_lat_z_s[:,1] = lat_sel_s
-    lon_lat_z_s[:,2] = z_sel_s
+        with open(args.output_path + 'mask_train_cl.pkl', 'wb') as f:         # bit-packed, time-major (see utils_targets.py)
+            pickle.dump(utils_targets.pack_mask(mask_train_cl, args.time_chunk), f)
 
-    pos = np.column_stack((lon_sel,lat_sel))
+        with open(args.output_path + 'mask_train_reg.pkl', 'wb') as f:
+            pickle.dump(utils_targets.pack_mask(mask_train_reg, args.time_chunk), f)
 
-    #-----------------------------------------------------
-    #----------------------- EDGES -----------------------
-    #-----------------------------------------------------
+    if 'graph' in stages:
 
-    edge_index = np.empty((2,0), dtype=int)
-    edge_attr = np.empty((2,0), dtype=float)
-
-    for ii, xi in enumerate(pos):
-        bool_lon = abs(pos[:,0] - xi[0]) < LON_DIFF_MAX
-        bool_lat = abs(pos[:,1] - xi[1]) < LAT_DIFF_MAX
-        bool_both = np.logical_and(bool_lon, bool_lat)
-        jj_list = np.flatnonzero(bool_both)
-        xj_list = pos[bool_both, :]
-        for jj, xj in zip(jj_list, xj_list):
-            if not np.array_equal(xi, xj):
-                edge_index = np.concatenate((edge_index, np.array([[ii], [jj]])), axis=-1, dtype=int)
-                edge_attr = np.concatenate((edge_attr, np.array([[xj[0] - xi[0]], [xj[1] - xi[1]]])), axis=-1, dtype=float)
-        #write_log(f"\nStart node: {xi} - done. Node has {n_neighbours} neighbours.", args)
-
-    edge_attr = edge_attr.swapaxes(0,1)
-    edge_attr[:,0] = edge_attr[:,0] / edge_attr[:,0].max() 
-    edge_attr[:,1] = edge_attr[:,1] / edge_attr[:,1].max()
+        #-------------------------------------------------
+        #----------- STANDARDISE LON LAT AND Z -----------
+        #-------------------------------------------------
     
-#    ## intervals to categorical values
-#    lon_m1 = edge_attr[:,0]<-0.5
-#    lon_0 = np.logical_and(edge_attr[:,0]>-0.5, edge_attr[:,0]<0.5)
-#    lon_1 = edge_attr[:,0]>0.5
-#    lat_m1 = edge_attr[:,1]<-0.5
-#    lat_0 = np.logical_and(edge_attr[:,1]>-0.5, edge_attr[:,1]<0.5)
-#    lat_1 = edge_attr[:,1]>0.5
-#    
-#    bool_N = np.logical_and(lon_0, lat_m1)     # (0, -1)
-#    bool_NE = np.logical_and(lon_m1, lat_m1)   # (-1,-1)
-#    bool_E = np.logical_and(lon_m1, lat_0)      # (-1, 0)
-#    bool_SE = np.logical_and(lon_m1, lat_1)    # (-1, 1)
-#    bool_S = np.logical_and(lon_0, lat_1)      # (0, 1)
-#    bool_SO = np.logical_and(lon_1, lat_1)     # (1, 1)
-#    bool_O = np.logical_and(lon_1, lat_0)      # (1, 0)
-#    bool_NO = np.logical_and(lon_1, lat_m1)    # (1, m)
-#
-#    edge_attr_cat = np.empty(edge_attr.shape[0], dtype=int)
-#    
-#    edge_attr_cat[bool_N] = 0
-#    edge_attr_cat[bool_NE] = 1
-#    edge_attr_cat[bool_E] = 2
-#    edge_attr_cat[bool_SE] = 3
-#    edge_attr_cat[bool_S] = 4
-#    edge_attr_cat[bool_SO] = 5
-#    edge_attr_cat[bool_O] = 6
-#    edge_attr_cat[bool_NO] = 7
+        use_precomputed_means_stds = True
+
+        if use_precomputed_means_stds:
+            write_log(f"\nUsing statistics over italy for lat, lon and z.", args)
+            with open("lat_lon_z_best.pkl", 'rb') as f:
+                lat_lon_z_best = pickle.load(f)
+            z_sel_s = (z_sel - np.mean(lat_lon_z_best[:,2])) / np.std(lat_lon_z_best[:,2])
+            lon_sel_s = (lon_sel - np.mean(lat_lon_z_best[:,1])) / np.std(lat_lon_z_best[:,1])
+            lat_sel_s = (lat_sel - np.mean(lat_lon_z_best[:,0])) / np.std(lat_lon_z_best[:,0])
+        else:
+            write_log(f"\nUsing local statistics for lat, lon and z.", args)
+            z_sel_s = (z_sel - z_sel.mean()) / z_sel.std()
+            lon_sel_s = (lon_sel - lon_sel.mean()) / lon_sel.std()
+            lat_sel_s = (lat_sel - lat_sel.mean()) / lat_sel.std()
     
-    #-----------------------------------------------------
-    #---------------------- GRAPHS -----------------------
-    #-----------------------------------------------------
+        lon_lat_z_s = np.empty((z_sel_s.shape[0], 3))
+
+        lon_lat_z_s[:,0] = lon_sel_s
+        lon_lat_z_s[:,1] = lat_sel_s
+        lon_lat_z_s[:,2] = z_sel_s
+
+        pos = np.column_stack((lon_sel,lat_sel))
 
-    ## create the graph objects
-    G_test = Data(num_nodes=z_sel_s.shape[0], pos=torch.tensor(pos), y=torch.tensor(pr_sel_test), pr_cl=torch.zeros(pr_sel_test.shape),
-            pr_reg=torch.zeros(pr_sel_test.shape), low_res=torch.tensor(abs(cell_idx_array)).int(), edge_index=torch.tensor(edge_index),
-            edge_attr=torch.tensor(edge_attr), x=torch.tensor(lon_lat_z_s))
-    G_train = Data(num_nodes=z_sel_s.shape[0], x=torch.tensor(lon_lat_z_s), edge_index=torch.tensor(edge_index), edge_attr=torch.tensor(edge_attr),
-            low_res=torch.tensor(abs(cell_idx_array)).int())
+        #-----------------------------------------------------
+        #----------------------- EDGES -----------------------
+        #-----------------------------------------------------
 
-    ## write some files
-    with open(args.output_path + 'G_test' + args.suffix + '.pkl', 'wb') as f:
-        pickle.dump(G_test, f)
+        start_edges = time.time()
+        edge_index, edge_attr = utils_graph.neighbour_edges(pos, (LON_DIFF_MAX, LAT_DIFF_MAX))
+        write_log(f"\nFound {edge_index.shape[1]} edges in {time.time() - start_edges} s.", args)
 
-    with open(args.output_path + 'G_train' + args.suffix + '.pkl', 'wb') as f:
-        pickle.dump(G_train, f)
+        edge_attr[:,0] = edge_attr[:,0] / edge_attr[:,0].max() 
+        edge_attr[:,1] = edge_attr[:,1] / edge_attr[:,1].max()
     
-    with open(args.output_path + 'target_train_cl.pkl', 'wb') as f:
-        pickle.dump(torch.tensor(pr_sel_train_cl), f)    
-     
-    with open(args.output_path + 'target_train_reg.pkl', 'wb') as f:
-        pickle.dump(torch.tensor(pr_sel_train_reg), f)    
-     
-    write_log(f"\nIn total, preprocessing took {time.time() - start} seconds", args)    
+    #    ## intervals to categorical values
+    #    lon_m1 = edge_attr[:,0]<-0.5
+    #    lon_0 = np.logical_and(edge_attr[:,0]>-0.5, edge_attr[:,0]<0.5)
+    #    lon_1 = edge_attr[:,0]>0.5
+    #    lat_m1 = edge_attr[:,1]<-0.5
+    #    lat_0 = np.logical_and(edge_attr[:,1]>-0.5, edge_attr[:,1]<0.5)
+    #    lat_1 = edge_attr[:,1]>0.5
+    #    
+    #    bool_N = np.logical_and(lon_0, lat_m1)     # (0, -1)
+    #    bool_NE = np.logical_and(lon_m1, lat_m1)   # (-1,-1)
+    #    bool_E = np.logical_and(lon_m1, lat_0)      # (-1, 0)
+    #    bool_SE = np.logical_and(lon_m1, lat_1)    # (-1, 1)
+    #    bool_S = np.logical_and(lon_0, lat_1)      # (0, 1)
+    #    bool_SO = np.logical_and(lon_1, lat_1)     # (1, 1)
+    #    bool_O = np.logical_and(lon_1, lat_0)      # (1, 0)
+    #    bool_NO = np.logical_and(lon_1, lat_m1)    # (1, m)
+    #
+    #    edge_attr_cat = np.empty(edge_attr.shape[0], dtype=int)
+    #    
+    #    edge_attr_cat[bool_N] = 0
+    #    edge_attr_cat[bool_NE] = 1
+    #    edge_attr_cat[bool_E] = 2
+    #    edge_attr_cat[bool_SE] = 3
+    #    edge_attr_cat[bool_S] = 4
+    #    edge_attr_cat[bool_SO] = 5
+    #    edge_attr_cat[bool_O] = 6
+    #    edge_attr_cat[bool_NO] = 7
+    
+        #-----------------------------------------------------
+        #---------------------- GRAPHS -----------------------
+        #-----------------------------------------------------
 
-    #-----------------------------------------------------
-    #---------------------- INDEXES ----------------------
-    #-----------------------------------------------------
+        ## create the graph objects
+        pr_sel_test = pr_sel[idx_time_test.min():idx_time_test.max()+1].swapaxes(0,1) # (num_nodes, time)
+        G_test = Data(num_nodes=z_sel_s.shape[0], pos=torch.tensor(pos), y=torch.tensor(pr_sel_test), pr_cl=torch.zeros(pr_sel_test.shape),
+                pr_reg=torch.zeros(pr_sel_test.shape), low_res=torch.tensor(abs(cell_idx_array)).int(), edge_index=torch.tensor(edge_index),
+                edge_attr=torch.tensor(edge_attr), x=torch.tensor(lon_lat_z_s))
+        G_train = Data(num_nodes=z_sel_s.shape[0], x=torch.tensor(lon_lat_z_s), edge_index=torch.tensor(edge_index), edge_attr=torch.tensor(edge_attr),
+                low_res=torch.tensor(abs(cell_idx_array)).int())
 
-    ## create the indexes list for the dataloader
-    write_log("\nLet's now create the list of indexes for the training.", args)
+        ## write some files
+        with open(args.output_path + 'G_test' + args.suffix + '.pkl', 'wb') as f:
+            pickle.dump(G_test, f)
 
-    start = time.time()
+        with open(args.output_path + 'G_train' + args.suffix + '.pkl', 'wb') as f:
+            pickle.dump(G_train, f)
 
-    idx_train_cl = []
-    idx_train_reg = []
-    
-    mask_train_cl = ~np.isnan(pr_sel_train_cl)
-    mask_train_reg = np.logical_and(~np.isnan(pr_sel_train_reg), pr_sel_train_reg >= threshold) 
-
-    c = 0
-    for s in range(space_low_res_dim):
-        mask_1 = np.in1d(cell_idx_array, s) # shape = (n_nodes)
-        if s in valid_examples_space:
-            c += 1
-            i = s // space_low_res_dim
-            j = s % space_low_res_dim
-            idx_list = np.array([ii * lon_low_res_dim + jj for ii in range(i-1,i+2) for jj in range(j-1,j+2)])
-            for t in idx_time_train:
-                if not (~mask_train_cl[mask_1,t]).all():
-                    k = t * space_low_res_dim + s
-                    idx_train_cl.append(k)
-                    if not (~mask_train_reg[mask_1,t]).all():
-                        idx_train_reg.append(k)
-            if c % 10 == 0:
-                write_log(f"\nSpace idx {s} done.", args)     
-    
-    idx_train_cl = np.array(idx_train_cl)
-    idx_train_reg = np.array(idx_train_reg)
+    if 'indexes' in stages:
 
-    write_log(f"\nCreating the idx array took {time.time() - start} seconds", args)    
+        #-----------------------------------------------------
+        #---------------------- INDEXES ----------------------
+        #-----------------------------------------------------
 
-    ## write some files
-    with open(args.output_path + 'idx_train_cl.pkl', 'wb') as f:
-        pickle.dump(idx_train_cl, f)
+        ## create the indexes list for the dataloader
+        write_log("\nLet's now create the list of indexes for the training.", args)
 
-    with open(args.output_path + 'idx_train_reg.pkl', 'wb') as f:
-        pickle.dump(idx_train_reg, f)
-    
-    with open(args.output_path + 'mask_train_cl.pkl', 'wb') as f:
-        pickle.dump(torch.tensor(mask_train_cl), f)
+        start_indexes = time.time()
 
-    with open(args.output_path + 'mask_train_reg.pkl', 'wb') as f:
-        pickle.dump(torch.tensor(mask_train_reg), f)
-    
-    write_log("\nDone!", args)
+        ## the masks are in memory if the targets were built in this run
+        if 'targets' not in stages:
+            with open(args.output_path + 'mask_train_cl.pkl', 'rb') as f:
+                mask_train_cl = utils_targets.unpack_mask(pickle.load(f))
+            with open(args.output_path + 'mask_train_reg.pkl', 'rb') as f:
+                mask_train_reg = utils_targets.unpack_mask(pickle.load(f))
+
+        ## a (cell, time) pair is an example if any node of the cell has a valid target at that time
+        ## (a valid regression target implies a valid classification target)
+        (cells_cl, times_cl), (cells_reg, times_reg) = utils_graph.cell_time_any([mask_train_cl, mask_train_reg],
+            cell_idx_array, valid_examples_space, idx_time_train, args.time_chunk)
+        idx_train_cl = times_cl * space_low_res_dim + cells_cl
+        idx_train_reg = times_reg * space_low_res_dim + cells_reg
 
+        write_log(f"\nCreating the idx array took {time.time() - start_indexes} seconds", args)    
 
+        ## write some files
+        with open(args.output_path + 'idx_train_cl.pkl', 'wb') as f:
+            pickle.dump(idx_train_cl, f)
+
+        with open(args.output_path + 'idx_train_reg.pkl', 'wb') as f:
+            pickle.dump(idx_train_reg, f)
+
+    write_log(f"\nIn total, preprocessing took {time.time() - start} seconds", args)
+    write_log("\nDone!", args)
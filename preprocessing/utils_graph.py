@@ -0,0 +1,228 @@
+import numpy as np
+
+from scipy.spatial import cKDTree
+
+import utils_gripho
+
+#-----------------------------------------------------
+#------------------ CELL MEMBERSHIPS -----------------
+#-----------------------------------------------------
+
+## A node belongs to the low res cell (i, j) if lat_low[i] <= lat <= lat_high[i] and
+## lon_low[j] <= lon <= lon_high[j] (borders included, so a node on a border belongs to
+## more than one cell). Since the bounds are increasing, the cells containing a value
+## along one axis are a contiguous range of indexes, found by binary search: this
+## costs O(n_nodes log n_cells) instead of one full pass over the nodes per cell.
+
+def axis_ranges(x, low, high):
+    '''
+    For each value in x, the range of the intervals [low[i], high[i]] containing it
+    Arguments:
+        x: array of coordinates
+        low, high: increasing arrays with the bounds of the intervals
+    Returns:
+        first, n: the index of the first interval containing each value and the number
+            of intervals containing it (0 if none)
+    '''
+    first = np.searchsorted(high, x, side='left')                  # first i with high[i] >= x
+    last = np.searchsorted(low, x, side='right') - 1               # last i with low[i] <= x
+    n = np.maximum(last - first + 1, 0)
+    return first, n
+
+def cell_memberships(lon, lat, lon_low, lon_high, lat_low, lat_high):
+    '''
+    Assigns the nodes to all the cells that contain them
+    Arguments:
+        lon, lat: the node coordinates
+        lon_low, lon_high, lat_low, lat_high: the cell bounds along each axis
+    Returns:
+        cells, nodes: the (cell index, node index) pairs, sorted by cell and then by node,
+            where the cell index is i * len(lon_low) + j
+    '''
+    lon_first, lon_n = axis_ranges(lon, lon_low, lon_high)
+    lat_first, lat_n = axis_ranges(lat, lat_low, lat_high)
+    cells, nodes = [], []
+    for di in range(lat_n.max(initial=0)):
+        for dj in range(lon_n.max(initial=0)):
+            inside = np.flatnonzero(np.logical_and(di < lat_n, dj < lon_n))
+            cells.append((lat_first[inside] + di) * len(lon_low) + lon_first[inside] + dj)
+            nodes.append(inside)
+    cells = np.concatenate(cells) if len(cells) > 0 else np.zeros(0, dtype=np.int64)
+    nodes = np.concatenate(nodes) if len(nodes) > 0 else np.zeros(0, dtype=np.int64)
+    order = np.lexsort((nodes, cells))
+    return cells[order], nodes[order]
+
+def node_validity(pr, time_chunk=8760):
+    '''
+    Counts the valid (not NaN) hours of each node with a single pass over the time
+    chunks of pr, so that no (time, n_nodes) temporary is allocated
+    Arguments:
+        pr: array of shape (time, n_nodes), or a utils_gripho.Node_reader
+        time_chunk: number of time steps per chunk
+    Returns:
+        ever_observed: boolean array, True for the nodes with at least one valid hour
+        n_valid_hours: int array with the number of valid hours of each node
+    '''
+    n_valid_hours = np.zeros(pr.shape[1], dtype=np.int64)
+    for _, _, chunk in utils_gripho.iter_time_chunks(pr, 0, pr.shape[0], time_chunk):
+        n_valid_hours += chunk.shape[0] - np.isnan(chunk).sum(axis=0)
+    return n_valid_hours > 0, n_valid_hours
+
+def cell_time_any(masks, cell_idx_array, cells, time_idxs, time_chunk=8760):
+    '''
+    For each cell and time, whether any of the nodes assigned to the cell is True in each
+    mask, with a segment reduction over the nodes grouped by cell (np.logical_or.reduceat)
+    computed in chunks of time
+    Arguments:
+        masks: list of boolean arrays of shape (time, n_nodes)
+        cell_idx_array: the cell of each node (nodes with other values are ignored)
+        cells: the cells to consider
+        time_idxs: the (increasing) time indexes to consider
+        time_chunk: number of time steps per chunk
+    Returns:
+        a list with, for each mask, the (cells, times) arrays of the True (cell, time) pairs,
+        sorted by cell and then by time
+    '''
+    cells = np.unique(np.asarray(cells))
+    time_idxs = np.asarray(time_idxs)
+    node_cells = np.asarray(cell_idx_array)
+    nodes = np.flatnonzero(np.isin(node_cells, cells))
+    if len(nodes) == 0:
+        return [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)) for _ in masks]
+    nodes = nodes[np.argsort(node_cells[nodes], kind='stable')]             # nodes grouped by cell
+    group_cells, group_starts = np.unique(node_cells[nodes], return_index=True)
+    group_cells = group_cells.astype(np.int64)
+    pairs = [([], []) for _ in masks]
+    for t_start in range(0, len(time_idxs), time_chunk):
+        t_chunk = time_idxs[t_start : t_start + time_chunk]
+        for m, mask in enumerate(masks):
+            any_valid = np.logical_or.reduceat(mask[np.ix_(t_chunk, nodes)], group_starts, axis=1)     # (len(t_chunk), n_groups)
+            t, g = np.nonzero(any_valid)
+            pairs[m][0].append(group_cells[g])
+            pairs[m][1].append(t_chunk[t])
+    result = []
+    for c, t in pairs:
+        c, t = np.concatenate(c), np.concatenate(t)
+        order = np.lexsort((t, c))
+        result.append((c[order], t[order]))
+    return result
+
+#-----------------------------------------------------
+#-------------------- CSR MASKS ----------------------
+#-----------------------------------------------------
+
+## The (cell, node) memberships are stored as a dict in CSR format: the nodes of cell s
+## are indices[indptr[s]:indptr[s+1]] (sorted), and n_nodes is the number of columns of
+## the equivalent dense (n_cells, n_nodes) boolean mask.
+
+def csr_from_pairs(rows, cols, n_rows, n_cols):
+    '''
+    Builds a CSR mask from (row, col) pairs sorted by row and then by col
+    '''
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+    return {'indptr': indptr, 'indices': np.asarray(cols, dtype=np.int64), 'n_nodes': int(n_cols)}
+
+def csr_select_columns(csr, keep):
+    '''
+    Restricts a CSR mask to the columns where keep is True, renumbering them
+    '''
+    new_idx = np.cumsum(keep) - 1
+    rows = np.repeat(np.arange(len(csr['indptr']) - 1), np.diff(csr['indptr']))
+    kept = keep[csr['indices']]
+    return csr_from_pairs(rows[kept], new_idx[csr['indices'][kept]], len(csr['indptr']) - 1, int(keep.sum()))
+
+def csr_row(csr, row):
+    '''
+    Returns the column indexes of a row of a CSR mask
+    '''
+    return csr['indices'][csr['indptr'][row] : csr['indptr'][row+1]]
+
+def csr_row_mask(csr, row):
+    '''
+    Returns a row of a CSR mask as a dense boolean array of length n_nodes
+    '''
+    mask = np.zeros(csr['n_nodes'], dtype=bool)
+    mask[csr_row(csr, row)] = True
+    return mask
+
+#-----------------------------------------------------
+#----------------- INDUCED SUBGRAPHS -----------------
+#-----------------------------------------------------
+
+## The subgraph of a row of a CSR mask keeps the nodes of the row, relabeled by their position
+## in the (sorted) row, and the edges with both ends in the row, in the order of edge_index
+## (as graph.subgraph(subset=mask) of torch_geometric). The edges of all the rows are found
+## in one pass over the edge list: each edge is repeated once for each row that contains its
+## source node and kept if the row also contains its target, with a binary search over the
+## sorted (row, node) keys of the mask.
+
+def induced_subgraphs(csr, edge_index):
+    '''
+    Computes the induced subgraphs of all the rows of a CSR mask
+    Arguments:
+        csr: CSR mask (see above) with the nodes of each subgraph
+        edge_index: int array of shape (2, n_edges) with the edges of the graph
+    Returns:
+        edge_ptr: int64 array of length n_rows + 1, the edges of row s are edge_ptr[s]:edge_ptr[s+1]
+        edge_ids: the ids (columns of edge_index) of the edges of each subgraph
+        local_edge_index: int64 array of shape (2, len(edge_ids)) with the relabeled edges
+    '''
+    indptr, indices, n_nodes = csr['indptr'], np.asarray(csr['indices'], dtype=np.int64), csr['n_nodes']
+    n_rows = len(indptr) - 1
+    rows = np.repeat(np.arange(n_rows, dtype=np.int64), np.diff(indptr))
+    keys = rows * n_nodes + indices                                         # sorted, since the rows are sorted
+    if len(keys) == 0:                                                      # no nodes in any row, so no edges
+        return np.zeros(n_rows + 1, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((2, 0), dtype=np.int64)
+    ## rows containing each node (the transposed mask)
+    node_order = np.argsort(indices, kind='stable')
+    node_ptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=n_nodes), out=node_ptr[1:])
+    node_rows = rows[node_order]
+    ## one candidate per (edge, row containing its source)
+    source, target = np.asarray(edge_index[0], dtype=np.int64), np.asarray(edge_index[1], dtype=np.int64)
+    counts = np.diff(node_ptr)[source]
+    edge_ids = np.repeat(np.arange(len(source)), counts)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    edge_rows = node_rows[np.repeat(node_ptr[source], counts) + np.arange(len(edge_ids)) - first]
+    target_keys = edge_rows * n_nodes + target[edge_ids]
+    target_pos = np.minimum(np.searchsorted(keys, target_keys), len(keys) - 1)
+    keep = keys[target_pos] == target_keys
+    edge_ids, edge_rows, target_pos = edge_ids[keep], edge_rows[keep], target_pos[keep]
+    source_pos = np.searchsorted(keys, edge_rows * n_nodes + source[edge_ids])
+    order = np.lexsort((edge_ids, edge_rows))
+    edge_ids, edge_rows, source_pos, target_pos = edge_ids[order], edge_rows[order], source_pos[order], target_pos[order]
+    edge_ptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edge_rows, minlength=n_rows), out=edge_ptr[1:])
+    local_edge_index = np.stack((source_pos - indptr[edge_rows], target_pos - indptr[edge_rows]))
+    return edge_ptr, edge_ids, local_edge_index
+
+#-----------------------------------------------------
+#----------------------- EDGES -----------------------
+#-----------------------------------------------------
+
+def neighbour_edges(pos, max_diffs):
+    '''
+    Connects the nodes whose coordinates differ by less than max_diffs along every
+    axis (nodes at the same position are not connected), with a KD-tree query on the
+    coordinates scaled by max_diffs instead of comparing every pair of nodes
+    Arguments:
+        pos: array of shape (n_nodes, 2) with the lon, lat of the nodes
+        max_diffs: the (lon, lat) maximum differences
+    Returns:
+        edge_index: int array of shape (2, n_edges), with both directions of each edge,
+            sorted by source node and then by target node
+        edge_attr: float array of shape (n_edges, 2) with pos[target] - pos[source]
+    '''
+    max_diffs = np.asarray(max_diffs, dtype=float)
+    tree = cKDTree(pos / max_diffs)
+    pairs = tree.query_pairs(r=1 + 1e-6, p=np.inf, output_type='ndarray')    # the radius has some slack, the exact (strict) test is below
+    diffs = pos[pairs[:,1]] - pos[pairs[:,0]]
+    keep = np.logical_and((np.abs(diffs) < max_diffs).all(axis=1), (diffs != 0).any(axis=1))
+    pairs = pairs[keep]
+    source = np.concatenate((pairs[:,0], pairs[:,1]))
+    target = np.concatenate((pairs[:,1], pairs[:,0]))
+    order = np.lexsort((target, source))
+    edge_index = np.stack((source[order], target[order])).astype(int)
+    edge_attr = pos[edge_index[1]] - pos[edge_index[0]]
+    return edge_index, edge_attr
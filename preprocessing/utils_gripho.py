@@ -0,0 +1,101 @@
+import numpy as np
+import xarray as xr
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+#-----------------------------------------------------
+#-------------- LAZY GRIPHO NODES READER -------------
+#-----------------------------------------------------
+
+## The GRIPHO precipitation is a (time, node) variable: only the nodes inside the window
+## and only one time chunk at a time are read from the netCDF file. The selected nodes are
+## read as runs of contiguous nodes (one hyperslab per run), so the nodes outside the
+## window are never loaded, apart from the short gaps inside a run.
+
+def node_runs(node_idx, max_gap=1024):
+    '''
+    Splits the sorted node indexes in runs, starting a new run when two consecutive
+    indexes are more than max_gap apart
+    Returns:
+        a list of (first, last + 1) node ranges
+    '''
+    if len(node_idx) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(node_idx) > max_gap)
+    starts = np.concatenate(([0], breaks + 1))
+    ends = np.concatenate((breaks, [len(node_idx) - 1]))
+    return [(int(node_idx[s]), int(node_idx[e]) + 1) for s, e in zip(starts, ends)]
+
+def read_nodes_chunk(path, var, node_idx, t_start, t_end):
+    '''
+    Reads the time steps in [t_start, t_end) of the given (sorted) nodes of a (time, node)
+    variable; used as process pool task, so it opens the file by itself
+    Returns:
+        an array of shape (t_end - t_start, len(node_idx))
+    '''
+    with xr.open_dataset(path) as f:
+        da = f[var]
+        blocks = []
+        for first, end in node_runs(node_idx):
+            run = node_idx[np.logical_and(node_idx >= first, node_idx < end)]
+            blocks.append(da[t_start:t_end, first:end].values[:, run - first])
+    if len(blocks) == 0:
+        return np.zeros((t_end - t_start, 0), dtype=np.float32)
+    return np.concatenate(blocks, axis=1)
+
+class Node_reader(object):
+    '''
+    Lazy, array-like (time, n_nodes) view of some nodes of a (time, node) netCDF variable:
+    time slices are read on demand, and iter_chunks reads consecutive time chunks in a
+    process pool, up to n_workers chunks ahead of the consumer
+    '''
+    def __init__(self, path, var, node_idx, n_workers=1):
+        self.path = path
+        self.var = var
+        self.node_idx = np.asarray(node_idx, dtype=np.int64)
+        self.n_workers = n_workers
+        with xr.open_dataset(path) as f:
+            time_dim = f[var].shape[0]
+        self.shape = (time_dim, len(self.node_idx))
+
+    def select_nodes(self, mask):
+        '''
+        Returns a reader of the nodes where mask (of length n_nodes) is True
+        '''
+        return Node_reader(self.path, self.var, self.node_idx[mask], self.n_workers)
+
+    def __getitem__(self, key):
+        start, stop, step = key.indices(self.shape[0])
+        if step != 1:
+            raise IndexError("Only contiguous time slices are supported.")
+        return read_nodes_chunk(self.path, self.var, self.node_idx, start, stop)
+
+    def iter_chunks(self, t_start, t_end, time_chunk):
+        bounds = [(t, min(t + time_chunk, t_end)) for t in range(t_start, t_end, time_chunk)]
+        if self.n_workers <= 1:
+            for t, t_stop in bounds:
+                yield t, t_stop, self[t:t_stop]
+            return
+        with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+            pending = deque()
+            for t, t_stop in bounds:
+                pending.append((t, t_stop, pool.submit(read_nodes_chunk, self.path, self.var, self.node_idx, t, t_stop)))
+                if len(pending) == self.n_workers:
+                    t_first, t_last, future = pending.popleft()
+                    yield t_first, t_last, future.result()
+            while len(pending) > 0:
+                t_first, t_last, future = pending.popleft()
+                yield t_first, t_last, future.result()
+
+def iter_time_chunks(pr, t_start, t_end, time_chunk):
+    '''
+    Yields (t_start, t_end, chunk) for the consecutive time chunks of pr, which is either
+    an array of shape (time, n_nodes) or a Node_reader (read in parallel)
+    '''
+    if isinstance(pr, Node_reader):
+        yield from pr.iter_chunks(t_start, t_end, time_chunk)
+        return
+    for t in range(t_start, t_end, time_chunk):
+        t_stop = min(t + time_chunk, t_end)
+        yield t, t_stop, np.asarray(pr[t:t_stop])
@@ -0,0 +1,106 @@
+import numpy as np
+import pickle
+
+from concurrent.futures import ProcessPoolExecutor
+
+#-----------------------------------------------------
+#------------- SINGLE PASS MEAN AND STD --------------
+#-----------------------------------------------------
+
+def chunk_moments(chunk):
+    '''
+    Computes the partial moments of a (time, var, lev, lat, lon) chunk for
+    each (variable, level), in double precision
+    Arguments:
+        chunk: array of shape (time, n_vars, n_levels, lat, lon)
+    Returns:
+        count, mean, m2: arrays of shape (n_vars, n_levels), where m2 is the
+            sum of the squared deviations from the mean
+    '''
+    chunk = np.asarray(chunk, dtype=np.float64)
+    count = np.full(chunk.shape[1:3], chunk.shape[0] * chunk.shape[3] * chunk.shape[4], dtype=np.float64)
+    mean = chunk.mean(axis=(0,3,4))
+    m2 = ((chunk - mean[None,:,:,None,None]) ** 2).sum(axis=(0,3,4))
+    return count, mean, m2
+
+def merge_moments(a, b):
+    '''
+    Merges two sets of partial moments (count, mean, m2) with the parallel
+    algorithm of Chan et al.; the merge is exact and order independent
+    '''
+    if a is None:
+        return b
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+    return count, mean, m2
+
+def reduce_levels(moments):
+    '''
+    Merges the per-(variable, level) moments into per-variable moments
+    '''
+    count, mean, m2 = moments
+    count_v = count.sum(axis=1)
+    mean_v = (count * mean).sum(axis=1) / count_v
+    m2_v = m2.sum(axis=1) + (count * (mean - mean_v[:,None]) ** 2).sum(axis=1)
+    return count_v, mean_v, m2_v
+
+def moments_to_stats(moments, mean_std_over_variable):
+    '''
+    Derives means and (population) stds from the accumulated moments
+    Arguments:
+        moments: the (count, mean, m2) tuple, per (variable, level)
+        mean_std_over_variable: same meaning as in preprocessing_era5.py,
+            i.e. if False the statistics are computed per variable only
+    Returns:
+        means, stds: arrays of shape (n_vars,) or (n_vars, n_levels)
+    '''
+    if not mean_std_over_variable:
+        moments = reduce_levels(moments)
+    count, mean, m2 = moments
+    return mean, np.sqrt(m2 / count)
+
+def accumulate_moments(fn, tasks, n_workers=1):
+    '''
+    Accumulates the moments returned by fn(*task) for each task, either serially
+    or in a process pool; only the small moments arrays go back to the parent
+    Arguments:
+        fn: a module-level function returning a (count, mean, m2) tuple
+        tasks: list of argument tuples for fn
+        n_workers: number of processes (1 = serial)
+    '''
+    moments = None
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            for m in pool.map(fn, *zip(*tasks)):
+                moments = merge_moments(moments, m)
+    else:
+        for task in tasks:
+            moments = merge_moments(moments, fn(*task))
+    return moments
+
+def stats_from_array(input_ds, mean_std_over_variable, chunk_size=8760):
+    '''
+    Computes means and stds of an in-memory (time, var, lev, lat, lon) array
+    with a single pass over its time chunks
+    '''
+    moments = None
+    for t_start in range(0, input_ds.shape[0], chunk_size):
+        moments = merge_moments(moments, chunk_moments(input_ds[t_start:t_start+chunk_size]))
+    return moments_to_stats(moments, mean_std_over_variable)
+
+def write_stats(means, stds, output_path, means_file="means.pkl", stds_file="stds.pkl"):
+    with open(output_path + means_file, 'wb') as f:
+        pickle.dump(means, f)
+    with open(output_path + stds_file, 'wb') as f:
+        pickle.dump(stds, f)
+
+def load_stats(stats_path, means_file="means.pkl", stds_file="stds.pkl"):
+    with open(stats_path + means_file, 'rb') as f:
+        means = pickle.load(f)
+    with open(stats_path + stds_file, 'rb') as f:
+        stds = pickle.load(f)
+    return means, stds
@@ -0,0 +1,335 @@
+import numpy as np
+import pickle
+import zlib
+import lzma
+import os
+
+#-----------------------------------------------------
+#--------------- ERA5 INPUT STORE I/O ----------------
+#-----------------------------------------------------
+
+## An input store is a directory containing a header.pkl, i.e. a dict with the 'format',
+## 'shape', 'dtype', 'params' (variables order), 'levels' (pressure levels order) and
+## 'layout' (axes order) of the data, plus
+##   - format 'raw':        data.bin, the raw array in C order, that can be memory-mapped
+##   - format 'compressed': chunks.bin, the concatenation of the compressed time chunks of
+##                          'chunk_hours' time steps each; chunk i is stored in the bytes
+##                          [offsets[i], offsets[i+1]) and compressed with 'codec'
+## 'time_start' and 'time_end' (if known) are the first and last time stamps of the data.
+## A raw store can also be written variable-major, i.e. with 'layout' (var, lev, time, lat, lon),
+## so that the time series of each (variable, level) plane is contiguous and a subset of the
+## planes can be read on its own; 'shape' is always given in the 'layout' order.
+## The values are stored with the header 'precision': 'float32', 'float16' or 'bfloat16';
+## bfloat16 values are stored as the upper 16 bits of the float32 values ('dtype' = uint16).
+## The same layout is read by the Dataset_pr classes (local_single/dataset.py).
+
+HEADER_FILE = 'header.pkl'
+DATA_FILE = 'data.bin'
+CHUNKS_FILE = 'chunks.bin'
+LAYOUTS = {'time_major': ('time', 'var', 'lev', 'lat', 'lon'), 'var_major': ('var', 'lev', 'time', 'lat', 'lon')}
+
+def get_codec(codec):
+    '''
+    Returns the (compress, decompress) functions of the given codec; zlib and lzma
+    come with the standard library, lz4 requires the lz4 package
+    '''
+    if codec == 'zlib':
+        return (lambda b: zlib.compress(b, 6)), zlib.decompress
+    elif codec == 'lzma':
+        return lzma.compress, lzma.decompress
+    elif codec == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise RuntimeError("The lz4 codec requires the lz4 package (pip install lz4).")
+        return lz4.frame.compress, lz4.frame.decompress
+    raise ValueError(f"Unknown codec '{codec}'.")
+
+STORAGE_DTYPES = {'float32': np.float32, 'float16': np.float16, 'bfloat16': np.uint16}
+
+def to_storage(chunk, precision):
+    '''
+    Converts a float32 array to the storage representation of the given precision;
+    bfloat16 is rounded to the nearest even value
+    '''
+    if precision == 'float32':
+        return np.asarray(chunk, dtype=np.float32)
+    elif precision == 'float16':
+        return np.asarray(chunk, dtype=np.float16)
+    elif precision == 'bfloat16':
+        u = np.ascontiguousarray(chunk, dtype=np.float32).view(np.uint32)
+        b = ((u + (0x7FFF + ((u >> 16) & 1))) >> 16).astype(np.uint16)
+        b[np.isnan(chunk)] = 0x7FC0
+        return b
+    raise ValueError(f"Unknown precision '{precision}'.")
+
+def from_storage(chunk, precision):
+    '''
+    Upcasts an array in the storage representation to float32
+    '''
+    if precision == 'bfloat16':
+        return (np.asarray(chunk, dtype=np.uint32) << 16).view(np.float32)
+    return np.asarray(chunk, dtype=np.float32)
+
+
+class Quantization_error(object):
+    '''
+    Keeps track of the per-(variable, level) absolute error introduced by storing
+    (time, var, lev, lat, lon) float32 chunks with a reduced precision
+    '''
+    def __init__(self, n_params, n_levels):
+        self.max = np.zeros((n_params, n_levels))
+        self.sum = np.zeros((n_params, n_levels))
+        self.count = 0
+
+    def update(self, chunk, stored, precision):
+        err = np.abs(from_storage(stored, precision).astype(np.float64) - chunk)
+        self.max = np.maximum(self.max, err.max(axis=(0,3,4)))
+        self.sum += err.sum(axis=(0,3,4))
+        self.count += chunk.shape[0] * chunk.shape[3] * chunk.shape[4]
+
+    def write_report(self, path, params, levels, precision):
+        mean = self.sum / self.count
+        with open(path, 'w') as f:
+            f.write(f"Quantization error of {precision} vs float32 (absolute error on the standardized values)\n")
+            f.write(f"\n{'variable':>10}{'level':>10}{'max':>16}{'mean':>16}")
+            for v, p in enumerate(params):
+                for l, lev in enumerate(levels):
+                    f.write(f"\n{p:>10}{str(lev):>10}{self.max[v,l]:16.8f}{mean[v,l]:16.8f}")
+            f.write("\n")
+            for v, p in enumerate(params):
+                f.write(f"\n{p:>10}{'all':>10}{self.max[v].max():16.8f}{mean[v].mean():16.8f}")
+            f.write(f"\n{'all':>10}{'all':>10}{self.max.max():16.8f}{mean.mean():16.8f}\n")
+
+
+def write_header(store_path, header):
+    with open(os.path.join(store_path, HEADER_FILE), 'wb') as f:
+        pickle.dump(header, f)
+
+def read_header(store_path):
+    with open(os.path.join(store_path, HEADER_FILE), 'rb') as f:
+        header = pickle.load(f)
+    return header
+
+def make_header(store_format, shape, params, levels, precision='float32', standardized=True, time_range=None, layout='time_major'):
+    '''
+    shape is given as (time, n_params, n_levels, lat, lon) and stored in the layout order
+    '''
+    shape = tuple(int(d) for d in shape)
+    if layout == 'var_major':
+        shape = shape[1:3] + shape[:1] + shape[3:]
+    header = {
+        'format': store_format,
+        'shape': shape,
+        'dtype': np.dtype(STORAGE_DTYPES[precision]).str,
+        'precision': precision,
+        'params': list(params),
+        'levels': list(levels),
+        'layout': LAYOUTS[layout],
+        'standardized': standardized,
+        }
+    if time_range is not None:
+        header['time_start'], header['time_end'] = str(time_range[0]), str(time_range[1])
+    return header
+
+def create_raw_store(store_path, shape, params, levels, precision='float32', standardized=True, time_range=None, layout='time_major'):
+    '''
+    Creates an empty raw store and returns a writable memory map of its data
+    Arguments:
+        store_path: path of the store directory (created if needed)
+        shape: (time, n_params, n_levels, lat, lon)
+        params, levels: the variables and pressure levels, in the order of the data
+        precision: precision of the stored values ('float32', 'float16' or 'bfloat16')
+        standardized: whether the stored values are already standardized
+        time_range: optional (first, last) time stamps of the data
+        layout: 'time_major' or 'var_major'
+    Returns:
+        a np.memmap of the given shape (in the layout order), opened in write mode
+    '''
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    header = make_header('raw', shape, params, levels, precision, standardized, time_range, layout)
+    write_header(store_path, header)
+    return np.memmap(os.path.join(store_path, DATA_FILE), dtype=header['dtype'], mode='w+', shape=header['shape'])
+
+
+class Raw_store_writer(object):
+    '''
+    Writes consecutive time chunks into a raw store; with a reduced precision
+    the quantization error is accumulated in self.error
+    '''
+    def __init__(self, store_path, shape, params, levels, precision='float32', standardized=True, time_range=None, layout='time_major'):
+        self.data = create_raw_store(store_path, shape, params, levels, precision, standardized, time_range, layout)
+        self.layout = layout
+        self.precision = precision
+        self.error = Quantization_error(shape[1], shape[2]) if precision != 'float32' else None
+        self.t = 0
+
+    def _to_storage(self, chunk):
+        stored = to_storage(chunk, self.precision)
+        if self.error is not None:
+            self.error.update(chunk, stored, self.precision)
+        return stored
+
+    def append(self, chunk):
+        if self.layout == 'var_major':
+            self.data[:, :, self.t : self.t + chunk.shape[0]] = self._to_storage(chunk).transpose(1, 2, 0, 3, 4)
+        else:
+            self.data[self.t : self.t + chunk.shape[0]] = self._to_storage(chunk)
+        self.t += chunk.shape[0]
+
+    def close(self):
+        self.data.flush()
+        del self.data
+
+
+class Npy_writer(Raw_store_writer):
+    '''
+    Writes consecutive time chunks into a .npy file
+    '''
+    def __init__(self, path, shape):
+        self.data = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+        self.layout = 'time_major'
+        self.precision = 'float32'
+        self.error = None
+        self.t = 0
+
+
+class Compressed_store_writer(Raw_store_writer):
+    '''
+    Writes consecutive time chunks of any length into a compressed store, re-chunking
+    them in blocks of chunk_hours time steps that are compressed independently
+    '''
+    def __init__(self, store_path, shape, params, levels, precision='float32', standardized=True, time_range=None, chunk_hours=25, codec='zlib'):
+        if not os.path.exists(store_path):
+            os.makedirs(store_path)
+        self.store_path = store_path
+        self.header = make_header('compressed', shape, params, levels, precision, standardized, time_range)
+        self.header['chunk_hours'] = chunk_hours
+        self.header['codec'] = codec
+        self.compress, _ = get_codec(codec)
+        self.precision = precision
+        self.error = Quantization_error(shape[1], shape[2]) if precision != 'float32' else None
+        self.offsets = [0]
+        self.buffer = []
+        self.buffer_len = 0
+        self.f = open(os.path.join(store_path, CHUNKS_FILE), 'wb')
+
+    def _write_chunk(self, chunk):
+        b = self.compress(np.ascontiguousarray(self._to_storage(chunk)).tobytes())
+        self.f.write(b)
+        self.offsets.append(self.offsets[-1] + len(b))
+
+    def append(self, chunk):
+        n = self.header['chunk_hours']
+        t = 0
+        if self.buffer_len > 0:                     # complete the chunk left over by the previous call
+            t = min(n - self.buffer_len, chunk.shape[0])
+            self.buffer.append(np.array(chunk[:t]))
+            self.buffer_len += t
+            if self.buffer_len < n:
+                return
+            self._write_chunk(np.concatenate(self.buffer, axis=0))
+            self.buffer, self.buffer_len = [], 0
+        while chunk.shape[0] - t >= n:
+            self._write_chunk(chunk[t : t + n])
+            t += n
+        if t < chunk.shape[0]:
+            self.buffer = [np.array(chunk[t:])]
+            self.buffer_len = chunk.shape[0] - t
+
+    def close(self):
+        if self.buffer_len > 0:
+            self._write_chunk(np.concatenate(self.buffer, axis=0))
+        self.f.truncate()
+        self.f.close()
+        self.header['offsets'] = np.array(self.offsets, dtype=np.int64)
+        write_header(self.store_path, self.header)
+
+
+def open_store_writer(store_path, shape, params, levels, precision='float32', standardized=True, time_range=None, codec=None, chunk_hours=25,
+    layout='time_major'):
+    '''
+    Returns a raw store writer, or a compressed store writer if a codec is given
+    '''
+    if codec is None:
+        return Raw_store_writer(store_path, shape, params, levels, precision, standardized, time_range, layout)
+    if layout != 'time_major':
+        raise ValueError("Compressed stores are chunked along time and only support the time_major layout.")
+    return Compressed_store_writer(store_path, shape, params, levels, precision, standardized, time_range, chunk_hours, codec)
+
+
+#-----------------------------------------------------
+#------------------- APPEND MODE ---------------------
+#-----------------------------------------------------
+
+## The appenders extend the time axis of an existing store in place: the data of the
+## existing time steps is left untouched (apart from the last, partial chunk of a
+## compressed store, which is rewritten with the first new time steps), so the time
+## indexes of the existing data stay valid. The header is only updated by close(),
+## and the store must not be read while the appender is open.
+
+class Raw_store_appender(Raw_store_writer):
+
+    def __init__(self, store_path, n_new, time_end=None):
+        self.store_path = store_path
+        self.header = read_header(store_path)
+        if self.header['layout'] != LAYOUTS['time_major']:
+            raise RuntimeError("Only time_major stores can be extended in place.")
+        self.layout = 'time_major'
+        self.precision = self.header.get('precision', 'float32')
+        self.error = Quantization_error(self.header['shape'][1], self.header['shape'][2]) if self.precision != 'float32' else None
+        self.t = self.header['shape'][0]
+        self.shape = (self.t + n_new,) + tuple(self.header['shape'][1:])
+        self.time_end = time_end
+        path = os.path.join(store_path, DATA_FILE)
+        with open(path, 'r+b') as f:
+            f.truncate(int(np.prod(self.shape)) * np.dtype(self.header['dtype']).itemsize)
+        self.data = np.memmap(path, dtype=self.header['dtype'], mode='r+', shape=self.shape)
+
+    def close(self):
+        super().close()
+        self.header['shape'] = self.shape
+        if self.time_end is not None:
+            self.header['time_end'] = str(self.time_end)
+        write_header(self.store_path, self.header)
+
+
+class Compressed_store_appender(Compressed_store_writer):
+
+    def __init__(self, store_path, n_new, time_end=None):
+        self.store_path = store_path
+        self.header = read_header(store_path)
+        self.compress, decompress = get_codec(self.header['codec'])
+        self.precision = self.header.get('precision', 'float32')
+        self.error = Quantization_error(self.header['shape'][1], self.header['shape'][2]) if self.precision != 'float32' else None
+        self.offsets = [int(o) for o in self.header['offsets']]
+        self.buffer = []
+        self.buffer_len = 0
+        self.shape = (self.header['shape'][0] + n_new,) + tuple(self.header['shape'][1:])
+        self.time_end = time_end
+        self.f = open(os.path.join(store_path, CHUNKS_FILE), 'r+b')
+        if self.header['shape'][0] % self.header['chunk_hours'] != 0:      # the last chunk is partial: it is rewritten together with the new data
+            start, end = self.offsets[-2], self.offsets[-1]
+            self.f.seek(start)
+            last = np.frombuffer(decompress(self.f.read(end - start)), dtype=self.header['dtype']).reshape((-1,) + self.shape[1:])
+            self.buffer = [from_storage(last, self.precision)]
+            self.buffer_len = last.shape[0]
+            self.offsets.pop()
+        self.f.seek(self.offsets[-1])
+
+    def close(self):
+        self.header['shape'] = self.shape
+        if self.time_end is not None:
+            self.header['time_end'] = str(self.time_end)
+        super().close()
+
+
+def open_store_appender(store_path, n_new, time_end=None):
+    '''
+    Returns an appender for the existing store, that extends its time axis by n_new steps
+    '''
+    header = read_header(store_path)
+    if header['format'] == 'compressed':
+        return Compressed_store_appender(store_path, n_new, time_end)
+    return Raw_store_appender(store_path, n_new, time_end)
@@ -0,0 +1,110 @@
+import numpy as np
+
+import utils_gripho
+
+#-----------------------------------------------------
+#---------- CLASSIFICATION AND REGRESSION ------------
+#-----------------------------------------------------
+
+def build_train_targets(pr, time_dim, threshold=0.1, time_chunk=8760, sparse_reg=False):
+    '''
+    Builds the classification and regression targets, and their masks, in a single pass
+    over the time chunks of pr; each chunk is processed with whole-array operations and
+    written straight into the preallocated time-major outputs (the rows of one hour are
+    contiguous), so the peak memory is one chunk plus the outputs
+    Arguments:
+        pr: precipitation of shape (time, n_nodes), or a utils_gripho.Node_reader (chunks read in parallel)
+        time_dim: number of time steps to process, starting from 0
+        threshold: precipitation threshold (mm) of the classification
+        time_chunk: number of time steps per chunk
+        sparse_reg: if True the regression target is built in the sparse format below
+    Returns:
+        target_cl: float32 array of shape (time_dim, n_nodes), 1 if pr >= threshold else 0, nan if pr is nan
+        target_reg: float32 array of shape (time_dim, n_nodes), log1p(pr) if pr >= threshold else nan,
+            or its sparse version if sparse_reg
+        mask_cl: boolean array of shape (time_dim, n_nodes), True where target_cl is not nan
+        mask_reg: boolean array of shape (time_dim, n_nodes), True where target_reg is not nan and target_reg >= threshold
+    '''
+    n_nodes = pr.shape[1]
+    target_cl = np.empty((time_dim, n_nodes), dtype=np.float32)
+    if sparse_reg:
+        indptr, indices, values = [np.zeros(1, dtype=np.int64)], [], []
+    else:
+        target_reg = np.empty((time_dim, n_nodes), dtype=np.float32)
+    mask_cl = np.empty((time_dim, n_nodes), dtype=bool)
+    mask_reg = np.empty((time_dim, n_nodes), dtype=bool)
+    for t_start, t_end, chunk in utils_gripho.iter_time_chunks(pr, 0, time_dim, time_chunk):
+        valid = ~np.isnan(chunk)
+        rain = chunk >= threshold
+        cl = rain.astype(np.float32)
+        cl[~valid] = np.nan
+        reg = np.where(rain, np.log1p(chunk), np.nan).astype(np.float32)
+        target_cl[t_start:t_end] = cl
+        if sparse_reg:
+            t, nodes = np.nonzero(rain)                                     # sorted by time and then by node
+            indptr.append(indptr[-1][-1] + np.cumsum(np.bincount(t, minlength=t_end - t_start)))
+            indices.append(nodes.astype(np.int32))
+            values.append(reg[t, nodes])
+        else:
+            target_reg[t_start:t_end] = reg
+        mask_cl[t_start:t_end] = valid
+        mask_reg[t_start:t_end] = np.logical_and(rain, reg >= threshold)
+    if sparse_reg:
+        target_reg = {'indptr': np.concatenate(indptr), 'indices': np.concatenate(indices), 'values': np.concatenate(values),
+            'n_nodes': n_nodes, 'layout': 'time_major'}
+    return target_cl, target_reg, mask_cl, mask_reg
+
+#-----------------------------------------------------
+#---------------- BIT-PACKED MASKS -------------------
+#-----------------------------------------------------
+
+## A bit-packed mask is a dict with 'packed', a uint8 array of shape (time, ceil(n_nodes / 8))
+## where the bit of node i at time t is (packed[t, i // 8] >> (7 - i % 8)) & 1 (np.packbits
+## big-endian bit order), 'n_nodes' and 'layout' = 'time_major': the flags of one hour are
+## contiguous and take 1 bit per node instead of 1 byte.
+
+def pack_mask(mask, time_chunk=8760):
+    '''
+    Bit-packs a boolean (time, n_nodes) mask into the format above, in time chunks
+    '''
+    time_dim, n_nodes = mask.shape
+    packed = np.empty((time_dim, (n_nodes + 7) // 8), dtype=np.uint8)
+    for t_start in range(0, time_dim, time_chunk):
+        packed[t_start : t_start + time_chunk] = np.packbits(mask[t_start : t_start + time_chunk], axis=1)
+    return {'packed': packed, 'n_nodes': n_nodes, 'layout': 'time_major'}
+
+def unpack_mask(mask):
+    '''
+    Returns the boolean (time, n_nodes) mask of a bit-packed mask
+    '''
+    return np.unpackbits(mask['packed'], axis=1, count=mask['n_nodes']).view(bool)
+
+#-----------------------------------------------------
+#-------------- SPARSE REGRESSION TARGET -------------
+#-----------------------------------------------------
+
+## A sparse target is a dict in CSR format by time: the observations of hour t are at the
+## nodes indices[indptr[t]:indptr[t+1]] (int32, sorted) with values values[indptr[t]:indptr[t+1]]
+## (float32); the missing entries are nan. 'n_nodes' and 'layout' = 'time_major' complete it.
+## Only the wet hours (pr >= threshold) of the regression target are stored.
+
+def sparse_to_dense(target):
+    '''
+    Returns the dense (time, n_nodes) float32 array of a sparse target (for checks and small data)
+    '''
+    time_dim = len(target['indptr']) - 1
+    dense = np.full((time_dim, target['n_nodes']), np.nan, dtype=np.float32)
+    t = np.repeat(np.arange(time_dim), np.diff(target['indptr']))
+    dense[t, target['indices']] = target['values']
+    return dense
+
+#-----------------------------------------------------
+#------------- TIME-MAJOR DENSE TARGETS --------------
+#-----------------------------------------------------
+
+## A dense target is written as a dict with 'dense', the float32 (time, n_nodes) array, 'n_nodes'
+## and 'layout' = 'time_major', so that the values of one hour are contiguous; the older files
+## are (n_nodes, time) torch tensors.
+
+def dense_target(target):
+    return {'dense': target, 'n_nodes': target.shape[1], 'layout': 'time_major'}
@@ -0,0 +1,89 @@
+import numpy as np
+import json
+
+#-----------------------------------------------------
+#--------------------- TIME INDEX --------------------
+#-----------------------------------------------------
+
+## The time indexes are the positions along the time axis of the GRIPHO (and ERA5) files,
+## which are hourly. A split is described declaratively by a dict, for example
+##
+##   {'train': {'end': '2015-12-01'},
+##    'test': {'start': '2015-12-01'},
+##    'warmup_hours': 24}
+##
+## where each split can select 'years' and 'months' (lists), a 'start' (included) and an 'end'
+## (excluded) date, and can 'exclude' a list of hold-out windows ({'start', 'end'} dicts); the
+## first warmup_hours time steps are excluded from every split, since the 25-hour input
+## window of a time step t starts at t - 24.
+
+DEFAULT_SPLIT = {
+    'train': {'end': '2015-12-01'},
+    'test': {'start': '2015-12-01'},
+    'warmup_hours': 24,
+    }
+
+class TimeIndex(object):
+    '''
+    The datetime coordinate of the time axis, with the year and month of each time step
+    precomputed, so that the splits are boolean operations over whole arrays
+    '''
+    def __init__(self, times):
+        self.times = np.asarray(times).astype('datetime64[h]')
+        self.years = self.times.astype('datetime64[Y]').astype(int) + 1970
+        self.months = self.times.astype('datetime64[M]').astype(int) % 12 + 1
+
+    def __len__(self):
+        return len(self.times)
+
+    def window(self, start=None, end=None):
+        '''
+        Returns the boolean mask of the time steps in [start, end)
+        '''
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self.times >= np.datetime64(start, 'h')
+        if end is not None:
+            mask &= self.times < np.datetime64(end, 'h')
+        return mask
+
+    def select(self, years=None, months=None, start=None, end=None, exclude=None):
+        '''
+        Returns the boolean mask of the time steps selected by a split description
+        '''
+        mask = self.window(start, end)
+        if years is not None:
+            mask &= np.isin(self.years, years)
+        if months is not None:
+            mask &= np.isin(self.months, months)
+        for holdout in exclude or []:
+            mask &= ~self.window(holdout.get('start'), holdout.get('end'))
+        return mask
+
+    def split(self, spec=DEFAULT_SPLIT):
+        '''
+        Returns a dict with the (sorted) int64 time indexes of each split in spec
+        '''
+        valid = np.arange(len(self)) >= spec.get('warmup_hours', 0)
+        return {name: np.flatnonzero(self.select(**selection) & valid) for name, selection in spec.items() if name != 'warmup_hours'}
+
+    def year_folds(self, years=None, warmup_hours=24):
+        '''
+        Leave-one-year-out folds: for each year, the time indexes of the other years
+        (train) and of that year (validation)
+        Returns:
+            a list of (train, validation) int64 arrays
+        '''
+        years = np.unique(self.years) if years is None else years
+        valid = np.arange(len(self)) >= warmup_hours
+        in_years = np.isin(self.years, years) & valid
+        return [(np.flatnonzero(in_years & (self.years != y)), np.flatnonzero(in_years & (self.years == y))) for y in years]
+
+def load_split_spec(path):
+    '''
+    Reads a split description from a json file (DEFAULT_SPLIT if path is None)
+    '''
+    if path is None:
+        return DEFAULT_SPLIT
+    with open(path, 'r') as f:
+        return json.load(f)